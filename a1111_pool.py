@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+import webuiapi
+
+from event_log import timed
+
+logger = logging.getLogger(__name__)
+
+# Keys of an api.a1111 backend entry used by the pool, not by webuiapi,
+# with their default value when neither the backend nor api sets them
+POOL_DEFAULTS = {
+    "concurrency": 1,
+    "pool_size": None,
+    "connect_timeout": 5,
+    "read_timeout": 600,
+}
+
+class TimeoutSession(requests.Session):
+    """
+    requests session applying a default timeout to every request,
+    webuiapi never passes one.
+    """
+
+    def __init__(self, timeout=None):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+def pooled_session(pool_size, timeout, auth=None):
+
+    session = TimeoutSession(timeout)
+    session.auth = auth
+
+    # keep-alive connections reused by every call to this backend
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+class Backend:
+
+    def __init__(self, backend_config, defaults={}):
+
+        settings = {
+            key: backend_config.get(key, defaults.get(key, default))
+            for key, default in POOL_DEFAULTS.items()
+        }
+
+        api_params = {
+            key: value
+            for key, value in backend_config.items()
+            if key not in POOL_DEFAULTS
+        }
+
+        self.api = webuiapi.WebUIApi(**api_params)
+        self.name = self.api.baseurl
+        self.concurrency = settings["concurrency"]
+
+        # one long-lived session per backend, shared by the
+        # txt2img calls routed to it
+        self.api.session = pooled_session(
+            settings["pool_size"] or self.concurrency + 1,
+            (settings["connect_timeout"], settings["read_timeout"]),
+            auth=self.api.session.auth
+        )
+
+        self.healthy = True
+        self.in_flight = 0
+        self.latency = 0.0
+
+    def load(self):
+        return self.in_flight / self.concurrency
+
+class BackendPool:
+    """
+    Route A1111 calls to the least-loaded healthy backend.
+
+    Each backend accepts at most `concurrency` calls in flight, callers
+    block until a slot is free. A connection error marks the backend as
+    unhealthy and the call is retried on another one, the probe thread
+    brings backends back once they answer again. When every backend is
+    down, callers wait up to `recovery_timeout` seconds for a probe to
+    bring one back.
+
+    Services outside the pool (the interrogator) are called with
+    post_external, on their own session: their errors never change
+    the health of the backends.
+    """
+
+    def __init__(
+            self,
+            backends,
+            probe_interval=30,
+            probe_timeout=5,
+            probe_retry_interval=2,
+            recovery_timeout=60,
+            external_timeout=None
+    ):
+
+        if len(backends) == 0:
+            raise ValueError(f"❌ Not enough a1111 backends ({len(backends)}).")
+
+        self.backends = backends
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.probe_retry_interval = probe_retry_interval
+        self.recovery_timeout = recovery_timeout
+
+        self.condition = threading.Condition()
+        self.probe_thread = None
+        self.probe_requested = threading.Event()
+        self.stopped = threading.Event()
+
+        # as many keep-alive connections as calls in flight, e.g. one
+        # interrogation per gen_images worker
+        self.external_session = pooled_session(self.capacity(), external_timeout)
+
+    def capacity(self):
+        return sum(backend.concurrency for backend in self.backends)
+
+    def start(self):
+
+        if self.probe_thread is None and self.probe_interval > 0:
+            self.probe_thread = threading.Thread(
+                target=self.probe_loop,
+                daemon=True
+            )
+            self.probe_thread.start()
+
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.probe_requested.set()
+
+    def probe_loop(self):
+
+        while not self.stopped.is_set():
+
+            # every probe_interval, or sooner when a caller
+            # waits for a backend to come back
+            self.probe_requested.wait(self.probe_interval)
+            self.probe_requested.clear()
+
+            if self.stopped.is_set():
+                return
+
+            self.probe()
+
+            # requested probes are spaced by probe_retry_interval
+            self.stopped.wait(self.probe_retry_interval)
+
+    def probe(self):
+
+        for backend in self.backends:
+
+            try:
+                response = backend.api.session.get(
+                    f"{backend.api.baseurl}/progress",
+                    params={"skip_current_image": "true"},
+                    timeout=self.probe_timeout
+                )
+                healthy = response.status_code == 200
+            except requests.exceptions.RequestException:
+                healthy = False
+
+            self.set_health(backend, healthy)
+
+    def set_health(self, backend, healthy):
+
+        with self.condition:
+            if healthy and not backend.healthy:
+                logger.info(f"✔ a1111 backend up - {backend.name}")
+            elif backend.healthy and not healthy:
+                logger.error(f"❌ a1111 backend down - {backend.name}")
+            backend.healthy = healthy
+            self.condition.notify_all()
+
+    def acquire(self, excluded=()):
+        """
+        Take a slot on the least-loaded healthy backend, preferring
+        backends not in excluded.
+        """
+
+        deadline = None
+
+        with self.condition:
+            while True:
+
+                healthy = [
+                    backend for backend in self.backends
+                    if backend.healthy
+                ]
+
+                if len(healthy) == 0:
+
+                    # wait a bounded time for the probe to bring one back
+                    if deadline is None:
+                        deadline = time.monotonic() + self.recovery_timeout
+
+                    remaining = deadline - time.monotonic()
+                    if self.probe_thread is None or remaining <= 0:
+                        raise RuntimeError("❌ no healthy a1111 backend available")
+
+                    self.probe_requested.set()
+                    self.condition.wait(remaining)
+                    continue
+
+                candidates = [
+                    backend for backend in healthy
+                    if backend not in excluded
+                ] or healthy
+
+                available = [
+                    backend for backend in candidates
+                    if backend.in_flight < backend.concurrency
+                ]
+
+                if len(available) > 0:
+                    backend = min(
+                        available,
+                        key=lambda b: (b.load(), b.latency)
+                    )
+                    backend.in_flight += 1
+                    return backend
+
+                self.condition.wait()
+
+    def release(self, backend, duration=None):
+
+        with self.condition:
+            backend.in_flight -= 1
+
+            # exponential moving average of the call latency
+            if duration is not None:
+                if backend.latency == 0.0:
+                    backend.latency = duration
+                else:
+                    backend.latency = 0.8 * backend.latency + 0.2 * duration
+
+            self.condition.notify_all()
+
+    def call(self, fn):
+        """
+        Run fn(backend) on the least-loaded healthy backend,
+        failing over to the next backend on connection errors.
+        """
+
+        tried = []
+
+        while True:
+
+            backend = self.acquire(excluded=tried)
+            start_time = time.monotonic()
+
+            try:
+                result = fn(backend)
+            except (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout
+            ) as e:
+                self.release(backend)
+                self.set_health(backend, False)
+                tried.append(backend)
+                logger.error(f"❌ a1111 backend failed, trying next one - {backend.name} - {e}")
+
+                # every backend failed at least once: give up
+                if len(tried) > len(self.backends):
+                    raise
+                continue
+            except Exception:
+                self.release(backend)
+                raise
+
+            self.release(backend, time.monotonic() - start_time)
+            return result
+
+    def post(self, url, payload, stats=None):
+        """
+        POST payload to url, resolved against the baseurl
+        of the selected backend.
+        Return the backend name and the webuiapi result.
+
+        stats, when given, is filled with the payload sha256 and size
+        and the encode, network and decode timings of the call.
+        """
+
+        if stats is None:
+            stats = {}
+
+        body = encode_payload(payload, stats)
+        timings = stats["timings"]
+
+        def post(backend):
+            backend_url = f"{backend.api.baseurl}{url}"
+
+            stats["backend"] = backend.name
+
+            with timed(timings, "network"):
+                response = backend.api.session.post(
+                    url=backend_url,
+                    data=body,
+                    headers={"Content-Type": "application/json"}
+                )
+
+            with timed(timings, "decode"):
+                result = backend.api._to_api_result(response)
+
+            return backend.name, result
+
+        return self.call(post)
+
+    def post_and_get_api_result(self, url, payload, stats=None):
+        return self.post(url, payload, stats)[1]
+
+    def post_external(self, url, payload, stats=None):
+        """
+        POST payload to a service outside the pool, e.g. the interrogator,
+        without taking a backend slot. Return the decoded json response.
+        """
+
+        if stats is None:
+            stats = {}
+
+        body = encode_payload(payload, stats)
+        timings = stats["timings"]
+        stats["backend"] = url
+
+        with timed(timings, "network"):
+            response = self.external_session.post(
+                url=url,
+                data=body,
+                headers={"Content-Type": "application/json"}
+            )
+
+        with timed(timings, "decode"):
+            if response.status_code != 200:
+                raise RuntimeError(response.status_code, response.text)
+
+            return response.json()
+
+def encode_payload(payload, stats):
+    """
+    JSON body of payload, its sha256, size and encode timing going to stats.
+    """
+
+    timings = stats.setdefault("timings", {})
+
+    # encoded once, whatever the number of failovers
+    with timed(timings, "encode"):
+        body = json.dumps(payload).encode()
+
+    stats["payload_hash"] = hashlib.sha256(body).hexdigest()
+    stats["payload_bytes"] = len(body)
+
+    return body
+
+def load_pool(config, config_filepath="config.json"):
+
+    if "api" not in config:
+        raise KeyError(f"❌ api not found in config file: {config_filepath}")
+
+    if "a1111" not in config["api"]:
+        raise KeyError(f"❌ a1111 not found in config file: {config_filepath}")
+
+    # a1111 can be a single backend or a list of backends
+    backends_config = config["api"]["a1111"]
+    if isinstance(backends_config, dict):
+        backends_config = [backends_config]
+
+    pool = BackendPool(
+        [
+            Backend(backend_config, config["api"])
+            for backend_config in backends_config
+        ],
+        probe_interval=config["api"].get("probe_interval", 30),
+        probe_timeout=config["api"].get("probe_timeout", 5),
+        probe_retry_interval=config["api"].get("probe_retry_interval", 2),
+        recovery_timeout=config["api"].get("recovery_timeout", 60),
+        external_timeout=(
+            config["api"].get("connect_timeout", POOL_DEFAULTS["connect_timeout"]),
+            config["api"].get("read_timeout", POOL_DEFAULTS["read_timeout"])
+        )
+    )
+
+    return pool.start()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ApiHealthMonitor:
+    """
+    Last known state of an API, kept up to date by a background task
+    probing every `interval` seconds while online. When offline, probes
+    back off from `retry_interval` up to `max_interval` seconds.
+
+    Callers read the state with is_online() and report what their own
+    requests observed with mark_online() / mark_offline().
+    """
+
+    def __init__(self, probe, interval=30, retry_interval=2, max_interval=60):
+
+        self.probe = probe
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.max_interval = max_interval
+
+        self.online = False
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def is_online(self) -> bool:
+        return self.online
+
+    def set_online(self, online):
+
+        if online != self.online:
+            logger.info(f"{'✅' if online else '❌'} API service {'available' if online else 'offline'}")
+
+        self.online = online
+
+    def mark_online(self):
+        self.set_online(True)
+
+    def mark_offline(self):
+        """
+        Flip to offline right away and start probing for recovery.
+        """
+
+        if self.online:
+            self.set_online(False)
+            self.wakeup.set()
+
+    async def check(self) -> bool:
+
+        try:
+            online = await self.probe()
+        except Exception as e:
+            logger.error(f"Error checking API health: {e}")
+            online = False
+
+        self.set_online(online)
+        return online
+
+    async def run(self):
+
+        delay = self.interval if self.online else self.retry_interval
+        failures = 0
+
+        while True:
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+            # woken up by mark_offline: restart the backoff
+            if self.wakeup.is_set():
+                self.wakeup.clear()
+                failures = 0
+                delay = self.retry_interval
+                continue
+
+            if await self.check():
+                failures = 0
+                delay = self.interval
+            else:
+                failures += 1
+                delay = min(self.retry_interval * 2 ** failures, self.max_interval)
+
+    async def start(self):
+        """
+        Probe once, then keep probing in the background.
+        """
+
+        await self.check()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
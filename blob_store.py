@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import base64
+import binascii
+import hashlib
+import os
+import re
+
+DEFAULT_BLOBS_ROOT = "./static/img/blobs/"
+
+# base64 strings shorter than this are kept as is
+BLOB_MIN_LENGTH = 256
+BLOB_PATTERN = re.compile(r"(data:[\w/+.-]+;base64,)?([A-Za-z0-9+/\r\n]+={0,2})")
+
+BLOB_EXTENSIONS = {
+    b"\x89PNG": ".png",
+    b"\xff\xd8\xff": ".jpg",
+    b"RIFF": ".webp",
+}
+
+def is_blob(value):
+
+    return isinstance(value, str) \
+        and len(value) >= BLOB_MIN_LENGTH \
+        and BLOB_PATTERN.fullmatch(value) is not None
+
+def blob_bytes(value):
+    """
+    Decoded bytes of a base64 blob, with or without data URI prefix.
+    None when value is not valid base64.
+    """
+
+    try:
+        return base64.b64decode(BLOB_PATTERN.fullmatch(value).group(2))
+    except (binascii.Error, ValueError):
+        return None
+
+def blob_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def blob_extension(data):
+
+    for magic, extension in BLOB_EXTENSIONS.items():
+        if data.startswith(magic):
+            return extension
+
+    return ".bin"
+
+class BlobStore:
+    """
+    Content-addressed files: root/<sha256[:2]>/<sha256><extension>,
+    each distinct content being written once.
+    """
+
+    def __init__(self, root=DEFAULT_BLOBS_ROOT):
+        self.root = root
+
+    def path(self, digest, extension):
+        return os.path.join(self.root, digest[:2], f"{digest}{extension}")
+
+    def put(self, data, digest=None):
+        """
+        Store data unless already stored, return its path.
+        """
+
+        if digest is None:
+            digest = blob_hash(data)
+
+        path = self.path(digest, blob_extension(data))
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write then rename: concurrent writers of the same
+        # content end up with the same complete file
+        tmp_path = f"{path}.{os.getpid()}.{id(data)}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        return path
+
+def strip_blobs(value, store=None, known_paths={}, relative_to=None):
+    """
+    Copy of value where base64 blobs are replaced by a reference:
+    {"blob": "sha256:<hex>", "length": <bytes>}.
+
+    With a store, the blob is written to it and the reference gets its
+    path, unless known_paths already maps the sha256 to a file holding
+    the same content, e.g. the generated PNG itself.
+    Paths are relative to relative_to when given.
+    """
+
+    if isinstance(value, dict):
+        return {
+            key: strip_blobs(item, store, known_paths, relative_to)
+            for key, item in value.items()
+        }
+
+    if isinstance(value, (list, tuple)):
+        return [
+            strip_blobs(item, store, known_paths, relative_to)
+            for item in value
+        ]
+
+    if not is_blob(value):
+        return value
+
+    data = blob_bytes(value)
+    if data is None:
+        return value
+
+    digest = blob_hash(data)
+    reference = {
+        "blob": f"sha256:{digest}",
+        "length": len(data)
+    }
+
+    if digest in known_paths:
+        path = known_paths[digest]
+    elif store is not None:
+        path = store.put(data, digest)
+    else:
+        return reference
+
+    if relative_to is not None:
+        path = os.path.relpath(path, relative_to)
+
+    reference["path"] = path
+
+    return reference
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+DEFAULT_DATABASE_PATH = "bot_data.db"
+
+# statements are compiled once and reused from the sqlite3 statement cache
+CREATE_IMAGE_DATA = '''
+CREATE TABLE IF NOT EXISTS image_data (
+    message_id INTEGER PRIMARY KEY,
+    photo_file_id TEXT,
+    legend TEXT,
+    likes INTEGER DEFAULT 0
+)
+'''
+INSERT_IMAGE_DATA = '''
+INSERT INTO image_data (message_id, photo_file_id, legend)
+VALUES (?, ?, ?)
+'''
+SELECT_IMAGE_DATA = 'SELECT photo_file_id, legend FROM image_data WHERE rowid = ?'
+INCREMENT_LIKES = 'UPDATE image_data SET likes = likes + 1 WHERE rowid = ? RETURNING likes'
+
+class BotDatabase:
+    """
+    tg_bot data layer: one persistent WAL-mode connection owned by a
+    dedicated thread, every query being awaited from the event loop
+    without blocking it.
+    """
+
+    def __init__(self, path=DEFAULT_DATABASE_PATH):
+
+        self.path = path
+
+        # a single worker: queries are serialised on the connection thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bot_db")
+        self.connection = self.executor.submit(self.connect).result()
+
+    def connect(self):
+
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(CREATE_IMAGE_DATA)
+        connection.commit()
+
+        return connection
+
+    async def run(self, fn, *args):
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    def close(self):
+
+        self.executor.submit(self.connection.close).result()
+        self.executor.shutdown()
+
+    def insert_image_data(self, message_id, photo_file_id, legend):
+
+        with self.connection:
+            cursor = self.connection.execute(
+                INSERT_IMAGE_DATA,
+                (message_id, photo_file_id, legend)
+            )
+
+        return cursor.lastrowid
+
+    def select_image_data(self, row_id):
+
+        return self.connection.execute(SELECT_IMAGE_DATA, (row_id,)).fetchone()
+
+    def increment_likes(self, row_id):
+
+        with self.connection:
+            row = self.connection.execute(INCREMENT_LIKES, (row_id,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    async def save_image_data(self, message_id: int, photo_file_id: str, legend: Optional[str]) -> int:
+        """
+        Save image data to the SQLite database.
+
+        Args:
+            message_id (int): The Telegram message ID.
+            photo_file_id (str): The file ID of the photo.
+            legend (Optional[str]): The caption of the photo, if any.
+
+        Returns:
+            int: The row id of the saved image data.
+        """
+        return await self.run(self.insert_image_data, message_id, photo_file_id, legend)
+
+    async def get_image_data(self, row_id: int) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        Return the (photo_file_id, legend) saved in row_id, None if not found.
+        """
+        return await self.run(self.select_image_data, row_id)
+
+    async def like(self, row_id: int) -> Optional[int]:
+        """
+        Add 1 to the like counter of row_id in one statement and
+        return the new total, None if not found.
+        """
+        return await self.run(self.increment_likes, row_id)
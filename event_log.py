@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+import contextlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from blob_store import strip_blobs
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EVENT_LOG_PATH = "./.cache/events.jsonl"
+
+@contextlib.contextmanager
+def timed(timings, name):
+    """
+    Add the duration of the block to timings[name], in seconds.
+    """
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start_time
+
+class EventLog:
+    """
+    Append-only JSONL log of backend calls, written from a background
+    thread: events are buffered and flushed every flush_interval
+    seconds, the file is rotated to path.1 ... path.<backups>
+    once it reaches max_bytes.
+
+    A path of None disables the log.
+    """
+
+    def __init__(
+            self,
+            path=DEFAULT_EVENT_LOG_PATH,
+            max_bytes=10 * 1024 ** 2,
+            backups=3,
+            flush_interval=1.0,
+            max_pending=4096
+    ):
+
+        self.path = path
+        self.enabled = path is not None
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.file = None
+        self.thread = None
+
+        if self.enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def log(self, event, **fields):
+        """
+        Queue an event, serialised in the writer thread with its
+        base64 blobs replaced by blob store references.
+        """
+
+        if not self.enabled:
+            return
+
+        try:
+            self.queue.put_nowait({
+                "ts": time.time(),
+                "event": event,
+                **fields
+            })
+        except queue.Full:
+            logger.error(f"❌ event log queue full, dropping {event} event")
+
+    def close(self):
+        """
+        Write every queued event, then stop the writer thread.
+        """
+
+        if self.thread is None:
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+
+        lines = []
+        flush_before = time.monotonic() + self.flush_interval
+        stop = False
+
+        while not stop:
+
+            try:
+                record = self.queue.get(timeout=max(flush_before - time.monotonic(), 0))
+                if record is None:
+                    stop = True
+                else:
+                    lines.append(json.dumps(strip_blobs(record), default=str) + "\n")
+            except queue.Empty:
+                pass
+
+            if stop or time.monotonic() >= flush_before:
+                try:
+                    self.write(lines)
+                except OSError as e:
+                    logger.error(f"❌ event log failed to write {self.path}: {e}")
+                lines = []
+                flush_before = time.monotonic() + self.flush_interval
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(self, lines):
+
+        if len(lines) == 0:
+            return
+
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+
+        for line in lines:
+
+            if self.file.tell() > 0 and self.file.tell() + len(line) > self.max_bytes:
+                self.rotate()
+
+            self.file.write(line)
+
+        self.file.flush()
+
+    def rotate(self):
+
+        self.file.close()
+
+        for index in range(self.backups - 1, 0, -1):
+            backup_path = f"{self.path}.{index}"
+            if os.path.exists(backup_path):
+                os.replace(backup_path, f"{self.path}.{index + 1}")
+
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+        self.file = open(self.path, "a", encoding="utf-8")
@@ -4,18 +4,34 @@ import os
 import itertools
 import traceback
 import datetime
-
+import threading
+import time
+import uuid
+import io
+import hashlib
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 import webuiapi
 from webuiapi import b64_img, raw_b64_img
 
 from PIL import Image
 import exif
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_file
 from werkzeug.utils import secure_filename
-
-import subprocess
-import shutil
+from werkzeug.datastructures import FileStorage
+
+from a1111_pool import load_pool
+from interrogator_cache import open_cache, image_hash
+from txt2img_batcher import Txt2ImgBatcher
+from upload_archiver import UploadArchiver
+from image_resize import resize_for_bucket
+from response_index import ResponseIndex
+from gallery_publisher import GalleryPublisher
+from payload_template import build_template, has_control_images, specialise
+from event_log import EventLog, DEFAULT_EVENT_LOG_PATH, timed
 
 CONFIG_FILE = 'config.json'
 UPLOAD_FOLDER = './uploads'
@@ -28,6 +44,42 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['GALLERY_FOLDER'] = GALLERY_FOLDER
 app.config['GIT_REPO_FOLDER'] = GIT_REPO_FOLDER
 app.config['CONFIG_FILE'] = CONFIG_FILE
+app.config['CONFIG_RELOAD'] = True
+
+# /gen job queue: 0 workers means one per a1111 pool slot
+app.config['GEN_WORKERS'] = 0
+app.config['GEN_QUEUE_SIZE'] = 256
+app.config['GEN_JOB_TTL'] = 3600
+app.config['GEN_MAX_WAIT'] = 60
+
+# /gen micro-batching: requests with the same payload arriving within
+# GEN_BATCH_WINDOW seconds share one a1111 call, 1 disables batching
+app.config['GEN_BATCH_WINDOW'] = 0.02
+app.config['GEN_BATCH_SIZE'] = 4
+
+# uploads, resized inputs and responses are written to UPLOAD_FOLDER
+# by a background archiver, off the request path
+app.config['ARCHIVE_UPLOADS'] = True
+
+# UPLOAD_FOLDER retention, checked every UPLOADS_PRUNE_INTERVAL seconds
+app.config['UPLOADS_MAX_AGE'] = 7 * 24 * 3600
+app.config['UPLOADS_MAX_BYTES'] = 2 * 1024 ** 3
+app.config['UPLOADS_PRUNE_INTERVAL'] = 3600
+
+# latest generated responses kept in memory for /keep
+app.config['RESPONSE_INDEX_SIZE'] = 100
+
+# /keep publishing: one git commit + push per window or max images
+app.config['GIT_REMOTE'] = 'origin'
+app.config['GALLERY_URL'] = "https://raw.githubusercontent.com/alx/api-call-matrix/refs/heads/main/gallery/{filename}"
+app.config['PUBLISH_WINDOW'] = 30
+app.config['PUBLISH_MAX_IMAGES'] = 10
+
+# JSONL log of every a1111 call, rotated at EVENT_LOG_MAX_BYTES,
+# None disables it
+app.config['EVENT_LOG_PATH'] = DEFAULT_EVENT_LOG_PATH
+app.config['EVENT_LOG_MAX_BYTES'] = 10 * 1024 ** 2
+app.config['EVENT_LOG_BACKUPS'] = 3
 
 def load_config():
 
@@ -37,205 +89,353 @@ def load_config():
     with open(app.config['CONFIG_FILE'], 'r') as f:
         config = json.load(f)
 
+    validate_config(config)
+
     return config
 
-def load_api():
+# Required config keys and their expected type
+CONFIG_SCHEMA = {
+    "runs": list,
+    "prompts": list,
+    "api": dict,
+}
 
-    config = load_config()
+def validate_config(config):
 
-    if "api" not in config:
-        raise KeyError(f"❌ api not found in config file")
+    for key, key_type in CONFIG_SCHEMA.items():
 
-    if "a1111" not in config["api"]:
-        raise KeyError(f"❌ a1111 not found in config file")
+        if key not in config:
+            raise KeyError(f"❌ {key} not found in config file: {app.config['CONFIG_FILE']}")
 
-    return webuiapi.WebUIApi(**config["api"]["a1111"])
+        if not isinstance(config[key], key_type):
+            raise TypeError(f"❌ {key} must be a {key_type.__name__} in config file: {app.config['CONFIG_FILE']}")
 
-config = load_config()
-api = load_api()
+def load_api(config):
 
-def process_interrogator(
-        input_image
-):
-    use_async = False
+    return load_pool(config, app.config['CONFIG_FILE'])
 
-    interrogator_config = config["api"]["interrogator"]
-    interrogator_prompt = ""
+archiver = UploadArchiver(
+    app.config['UPLOAD_FOLDER'],
+    enabled=app.config['ARCHIVE_UPLOADS']
+)
+archiver.start_pruning(
+    app.config['UPLOADS_PRUNE_INTERVAL'],
+    max_age=app.config['UPLOADS_MAX_AGE'],
+    max_bytes=app.config['UPLOADS_MAX_BYTES']
+)
+
+response_index = ResponseIndex(app.config['RESPONSE_INDEX_SIZE'])
+
+gallery_publisher = GalleryPublisher(
+    app.config['GIT_REPO_FOLDER'],
+    app.config['GALLERY_FOLDER'],
+    remote=app.config['GIT_REMOTE'],
+    window=app.config['PUBLISH_WINDOW'],
+    max_images=app.config['PUBLISH_MAX_IMAGES']
+)
+# images queued during the publish window are pushed on shutdown
+atexit.register(gallery_publisher.stop)
+
+def merge_prompt(sd_run, prompt):
+
+    prompt_data = {
+        "prompt": "",
+        "negative_prompt": ""
+    }
+
+    if "positive" in prompt:
+        prompt_data["prompt"] = prompt["positive"]
+    if "positive" in sd_run:
+        prompt_data["prompt"] += sd_run["positive"]
+    if "positive_prefix" in sd_run:
+        prompt_data["prompt"] = sd_run["positive_prefix"] + prompt_data["prompt"]
+    if "positive_suffix" in sd_run:
+        prompt_data["prompt"] = prompt_data["prompt"] + sd_run["positive_suffix"]
+
+    if "negative" in prompt:
+        prompt_data["negative_prompt"] = prompt["negative"]
+    if "negative" in sd_run:
+        prompt_data["negative_prompt"] += sd_run["negative"]
+
+    return prompt_data
+
+def reactor_args(input_image):
+
+    # include ReActor extension parameters in prompt_data
+    reactor = webuiapi.ReActor(
+        img=input_image,
+        source_faces_index = "0,1,2,3", #2 Comma separated face number(s) from swap-source image
+        faces_index = "0,1,2,3", #3 Comma separated face number(s) for target image (result)
+        upscaler_name =  "None",# None, # "R-ESRGAN 4x+", #8 Upscaler (type 'None' if doesn't need), see full list here: http://127.0.0.1:7860/sdapi/v1/script-info -> reactor -> sec.8
+        swap_in_source = True,
+        console_logging_level = 2, #13 Console Log Level (0 - min, 1 - med or 2 - max)
+        codeFormer_weight = 1,
+        target_hash_check = True,
+        mask_face = False,
+    )
+
+    return reactor.to_dict()
+
+def build_run_template(sd_run):
+
+    run_template = build_template(sd_run["params"])
+
+    if "is_reactor" in sd_run \
+        and sd_run["is_reactor"]:
+        run_template["restore_faces"] = False
+
+    return run_template
+
+def build_config_index(config):
+    """
+    Lookups done on every request, computed once per config load:
+    enabled run, enabled prompts by slug_id, their pre-merged
+    payload templates and /prompts JSON.
+    """
+
+    enabled_runs = [
+        r for r in config["runs"]
+        if r["enabled"]
+    ]
+
+    # first enabled prompt wins for a duplicated slug_id
+    prompts_by_slug = {}
+    for p in config["prompts"]:
+        if p["enabled"]:
+            prompts_by_slug.setdefault(p["slug_id"], p)
+
+    prompts_json = json.dumps(config["prompts"])
+
+    sd_run = enabled_runs[0] if len(enabled_runs) > 0 else None
+    run_template = None
+    templates = {}
+
+    if sd_run is not None:
+        run_template = build_run_template(sd_run)
+        templates = {
+            slug: run_template | merge_prompt(sd_run, prompt)
+            for slug, prompt in prompts_by_slug.items()
+        }
+
+    return {
+        "sd_run": sd_run,
+        "prompts": prompts_by_slug,
+        "run_template": run_template,
+        "templates": templates,
+        "prompts_json": prompts_json,
+        "prompts_etag": hashlib.sha256(prompts_json.encode()).hexdigest()
+    }
+
+config = load_config()
+config_index = build_config_index(config)
+config_mtime = os.path.getmtime(app.config['CONFIG_FILE'])
+config_lock = threading.Lock()
+api = load_api(config)
+
+# event_log_* keys of config.json override the app.config defaults
+event_log = EventLog(
+    config.get("event_log_path", app.config['EVENT_LOG_PATH']),
+    max_bytes=config.get("event_log_max_bytes", app.config['EVENT_LOG_MAX_BYTES']),
+    backups=config.get("event_log_backups", app.config['EVENT_LOG_BACKUPS'])
+)
+atexit.register(event_log.close)
+
+@app.before_request
+def reload_config():
+    """
+    Reload config.json when its modification time changed,
+    the a1111 pool being rebuilt only if the api section changed.
+    """
+    global config, config_index, config_mtime, api, gen_executor
+
+    if not app.config['CONFIG_RELOAD']:
+        return
+
+    # missing while an editor saves it by rename: keep the current config
+    try:
+        mtime = os.path.getmtime(app.config['CONFIG_FILE'])
+    except OSError:
+        return
+
+    if mtime == config_mtime:
+        return
+
+    with config_lock:
+
+        if mtime == config_mtime:
+            return
+
+        # keep serving the previous config if the new one is invalid
+        try:
+            new_config = load_config()
+        except (OSError, KeyError, TypeError, ValueError) as e:
+            app.logger.error("❌ config reload failed: %s", e)
+            config_mtime = mtime
+            return
+
+        if new_config["api"] != config["api"]:
+            api.stop()
+            api = load_api(new_config)
+
+            # one worker per slot of the new pool, the queued
+            # jobs still run on the previous workers
+            if not app.config['GEN_WORKERS']:
+                previous_executor = gen_executor
+                gen_executor = load_gen_executor(api)
+                previous_executor.shutdown(wait=False)
+
+        config = new_config
+        config_index = build_config_index(new_config)
+        config_mtime = mtime
+        app.logger.info("✔ config reloaded")
+
+def post_interrogator(
+        image_b64,
+        interrogator_url,
+        interrogator_config
+):
 
     interrogator_params = {
-        "image": b64_img(input_image),
+        "image": image_b64,
         "clip_model_name": interrogator_config["clip_model_name"],
         "mode": interrogator_config["mode"]
     }
 
-    interrogator_url = f'http://{interrogator_config["host"]}:{interrogator_config["port"]}/{interrogator_config["prompt_endpoint"]}'
+    stats = {}
+    status = "failed"
 
     try:
-
-        interrogator_response = api.post_and_get_api_result(
+        # the interrogator is not an a1111 backend: its errors
+        # must not mark the backends down
+        interrogator_response = api.post_external(
             interrogator_url,
             interrogator_params,
-            use_async
+            stats
         )
 
         # Check if an exception occured
-        response_prompt = interrogator_response.json["prompt"]
+        response_prompt = interrogator_response["prompt"]
         if "Exception" in response_prompt:
             raise RuntimeError
 
-        else:
+        status = "done"
+
+    finally:
+        event_log.log("interrogate", status=status, **stats)
+
+    return response_prompt
+
+def process_interrogator(
+        input_image
+):
+    interrogator_config = config["api"]["interrogator"]
+    interrogator_prompt = ""
+
+    # Interrogation only depends on the image and interrogator settings
+    interrogator_cache = open_cache(interrogator_config)
+    cache_key = None
+    response_prompt = None
+
+    if interrogator_cache is not None:
+        cache_key = interrogator_cache.key(
+            image_hash(input_image),
+            interrogator_config["clip_model_name"],
+            interrogator_config["mode"]
+        )
+        response_prompt = interrogator_cache.get(cache_key)
+
+    interrogator_url = f'http://{interrogator_config["host"]}:{interrogator_config["port"]}/{interrogator_config["prompt_endpoint"]}'
+
+    try:
+
+        if response_prompt is None:
+            response_prompt = post_interrogator(
+                b64_img(input_image),
+                interrogator_url,
+                interrogator_config
+            )
+
+            if interrogator_cache is not None:
+                interrogator_cache.set(cache_key, response_prompt)
 
-            # Get TOP results from prompt
-            if "sliced_top_prompts" in interrogator_config:
+        # Get TOP results from prompt
+        if "sliced_top_prompts" in interrogator_config:
 
-                interrogator_prompt = ",".join(itertools.islice(
-                    response_prompt.split(","),
-                    interrogator_config["sliced_top_prompts"]
-                ))
+            interrogator_prompt = ",".join(itertools.islice(
+                response_prompt.split(","),
+                interrogator_config["sliced_top_prompts"]
+            ))
 
-            else:
+        else:
 
-                interrogator_prompt = response_prompt
+            interrogator_prompt = response_prompt
 
     except RuntimeError:
         app.logger.error(f"❌ interrogator runtime error")
+    except requests.exceptions.RequestException as e:
+        app.logger.error(f"❌ interrogator unreachable - {e}")
 
     return interrogator_prompt
 
 def load_prompt_data(input_image, slug="", prompt_text="", width=1024, height=1024):
 
-    sd_run = [
-        r for r in config["runs"]
-        if r["enabled"]
-    ][0]
+    sd_run = config_index["sd_run"]
+    if sd_run is None:
+        raise LookupError("No enabled run")
 
-    available_prompts = [
-        p for p in config["prompts"]
-        if p["enabled"] and p["slug_id"] == slug
-    ]
-    if len(available_prompts) == 0:
+    # only the per-request fields are swapped in the shared template
+    fields = {
+        "width": width,
+        "height": height
+    }
+
+    template = config_index["templates"].get(slug)
+    if template is None:
         if len(prompt_text) > 0:
-            prompt = {
+            template = config_index["run_template"]
+            fields |= merge_prompt(sd_run, {
                 "slug_id": "forced_prompt",
                 "positive": prompt_text
-            }
+            })
         else:
             return None
-    else:
-        prompt = available_prompts[0]
-
-    # populate prompt_data with sd_run
-    prompt_data = sd_run["params"]
-    prompt_data["prompt"] = ""
-    prompt_data["negative_prompt"] = ""
-
-    prompt_data["width"] = width
-    prompt_data["height"] = height
-
-    if "positive" in prompt:
-        prompt_data["prompt"] = prompt["positive"]
-    if "positive" in sd_run:
-        prompt_data["prompt"] += sd_run["positive"]
-    if "positive_prefix" in sd_run:
-        prompt_data["prompt"] = sd_run["positive_prefix"] + prompt_data["prompt"]
-    if "positive_suffix" in sd_run:
-        prompt_data["prompt"] = prompt_data["prompt"] + sd_run["positive_suffix"]
 
-    if "negative" in prompt:
-        prompt_data["negative_prompt"] = prompt["negative"]
-    if "negative" in sd_run:
-        prompt_data["negative_prompt"] += sd_run["negative"]
-
-    controlnet_units = []
-    if "alwayson_scripts" in prompt_data:
-        if "ControlNet" in prompt_data["alwayson_scripts"]:
-            if "args" in prompt_data["alwayson_scripts"]["ControlNet"]:
-
-                for control in prompt_data["alwayson_scripts"]["ControlNet"]["args"]:
-
-                    # replace placeholder in prompt_data controlnets
-                    if "image" in control:
-                        control["image"] = raw_b64_img(input_image)
-
-                    controlnet_units.append(control)
-
-    prompt_data["controlnet_units"] = controlnet_units
+    # encode the input image once for every controlnet unit
+    control_image = None
+    if has_control_images(template):
+        control_image = raw_b64_img(input_image)
 
+    reactor = None
     if "is_reactor" in sd_run \
         and sd_run["is_reactor"]:
+        reactor = reactor_args(input_image)
 
-        prompt_data["restore_faces"] = False
-
-        # include ReActor extension parameters in prompt_data
-        reactor = webuiapi.ReActor(
-            img=input_image,
-            source_faces_index = "0,1,2,3", #2 Comma separated face number(s) from swap-source image
-            faces_index = "0,1,2,3", #3 Comma separated face number(s) for target image (result)
-            upscaler_name =  "None",# None, # "R-ESRGAN 4x+", #8 Upscaler (type 'None' if doesn't need), see full list here: http://127.0.0.1:7860/sdapi/v1/script-info -> reactor -> sec.8
-            swap_in_source = True,
-            console_logging_level = 2, #13 Console Log Level (0 - min, 1 - med or 2 - max)
-            codeFormer_weight = 1,
-            target_hash_check = True,
-            mask_face = False,
-        )
-
-        prompt_data["alwayson_scripts"]["reactor"] = {
-            "args": reactor.to_dict()
-        }
-
-    return prompt_data
+    return specialise(
+        template,
+        control_image=control_image,
+        reactor_args=reactor,
+        **fields
+    )
 
 def get_resized_image_file(input_image):
+    """
+    Decode and resize the upload in memory,
+    the archiver keeps a copy of both images on disk.
+    """
 
     input_filename = secure_filename(input_image.filename)
     input_filename = input_filename.replace(".jpg", datetime.datetime.now().strftime("_%Y-%m-%d_%H-%M-%S.jpg"))
-    input_filepath = os.path.join(app.config['UPLOAD_FOLDER'], input_filename)
-    input_image.save(input_filepath)
-
-    resized_image = Image.open(input_filepath).convert("RGB")
-    width, height = resized_image.size
-    is_square = width == height
-    is_landscape = width > height
-
-    # Calculate target dimensions
-    if is_square:
-        target_width = 1024
-        target_height = 1024
-    else:
-        if is_landscape:
-            target_width = 1344
-            target_height = 768
-        else:
-            target_width = 768
-            target_height = 1344
-
-    # Calculate aspect ratios
-    aspect_ratio = width / height
-    target_aspect_ratio = target_width / target_height
 
-    # Resize image
-    if aspect_ratio > target_aspect_ratio:
-        new_height = target_height
-        new_width = int(new_height * aspect_ratio)
-    else:
-        new_width = target_width
-        new_height = int(new_width / aspect_ratio)
+    upload_bytes = input_image.read()
+    archiver.archive(input_filename, upload_bytes)
 
-    resized_image = resized_image.resize((new_width, new_height), Image.LANCZOS)
-
-    # Center crop
-    left = (new_width - target_width) // 2
-    top = (new_height - target_height) // 2
-    right = left + target_width
-    bottom = top + target_height
-    resized_image = resized_image.crop((left, top, right, bottom))
-
-    new_width = int(right - left)
-    new_height = int(bottom - top)
+    # crop box first, then draft decode + reduce + final LANCZOS step
+    resized_image, new_width, new_height = resize_for_bucket(
+        Image.open(io.BytesIO(upload_bytes))
+    )
 
     resized_filename = input_filename.replace(".jpg", "_resized.jpg")
-    resized_filepath = os.path.join(app.config['UPLOAD_FOLDER'], resized_filename)
-    resized_image.save(resized_filepath)
+    archiver.archive(resized_filename, resized_image, "JPEG")
 
     return resized_image, input_filename, new_width, new_height
 
@@ -248,37 +448,63 @@ def interrogate_image():
     interrogator_prompt = process_interrogator(resized_image)
     return interrogator_prompt
 
-@app.route("/gen", methods=['POST'])
-def gen_image():
+def post_txt2img(payload):
 
-    if 'image' not in request.files:
-        return "Bad Request", 400
+    stats = {}
+    status = "failed"
+
+    try:
+        response = api.post_and_get_api_result("/txt2img", payload, stats)
+        status = "done"
+    finally:
+        event_log.log(
+            "txt2img",
+            batch_size=payload.get("batch_size", 1),
+            status=status,
+            **stats
+        )
+
+    return response
+
+txt2img_batcher = Txt2ImgBatcher(
+    post_txt2img,
+    window=app.config['GEN_BATCH_WINDOW'],
+    max_batch_size=app.config['GEN_BATCH_SIZE']
+)
+
+def generate_image(input_image, values, job_id=None):
+    """
+    Resize input_image, send it to a1111 with the requested prompt
+    and return the response record added to response_index.
+    """
 
-    input_image = request.files['image']
     resized_image, input_filename, width, height = get_resized_image_file(input_image)
 
-    if "prompt" in request.values:
+    prompt_data = None
+
+    if "prompt" in values:
         prompt_data = load_prompt_data(
             resized_image,
-            slug=request.values["prompt"],
+            slug=values["prompt"],
             width=width,
             height=height
         )
 
-    if "prompt-text" in request.values:
+    if "prompt-text" in values:
         prompt_data = load_prompt_data(
             resized_image,
-            prompt_text=request.values["prompt-text"],
+            prompt_text=values["prompt-text"],
             width=width,
             height=height
         )
 
     if prompt_data is None:
-        return "Prompt slug not found", 404
-
-    try:
+        raise LookupError("Prompt slug not found")
 
+    timings = {}
+    status = "failed"
 
+    try:
         #####
         #
         #
@@ -286,57 +512,237 @@ def gen_image():
         #
         #
         #####
-        response = api.post_and_get_api_result(
-            f"{api.baseurl}/txt2img",
-            prompt_data,
-            False
-        )
+        with timed(timings, "wait"):
+            response_image = txt2img_batcher.submit(prompt_data)
 
         response_filename = input_filename.replace(".jpg", "_response.png")
-        response_filepath = os.path.join(app.config['UPLOAD_FOLDER'], response_filename)
-        response.images[0].save(response_filepath)
-
-        # TODO save prompt inside exif data
-        # with open(response_filepath, 'wb') as image_file:
-        #     exif_image = exif.Image(image_file)
-        #     exif_image["prompt"] = prompt_data["positive"]
-        #     exif_image.write(exif_image.get_file())
-
-        return send_from_directory(
-            app.config['UPLOAD_FOLDER'],
-            response_filename
+
+        with timed(timings, "save"):
+            with io.BytesIO() as response_bytes:
+                response_image.save(response_bytes, format="PNG")
+                response_png = response_bytes.getvalue()
+
+        status = "done"
+
+    finally:
+        # the a1111 call itself is logged by post_txt2img,
+        # possibly batched with other requests
+        event_log.log(
+            "gen",
+            job=job_id,
+            client=values.get("client"),
+            input_filename=input_filename,
+            status=status,
+            timings=timings
         )
 
+    archiver.archive(response_filename, response_png)
+
+    # TODO save prompt inside exif data
+    # with open(response_filepath, 'wb') as image_file:
+    #     exif_image = exif.Image(image_file)
+    #     exif_image["prompt"] = prompt_data["positive"]
+    #     exif_image.write(exif_image.get_file())
+
+    response_id = response_index.add(
+        response_filename,
+        response_png,
+        client=values.get("client")
+    )
+
+    return response_index.get(response_id)
+
+# Queued /gen jobs by id
+gen_jobs = {}
+gen_jobs_lock = threading.Lock()
+
+def load_gen_executor(api):
+
+    return ThreadPoolExecutor(
+        max_workers=app.config['GEN_WORKERS'] or api.capacity()
+    )
+
+gen_executor = load_gen_executor(api)
+
+def run_gen_job(job_id, input_image, values):
+
+    job = gen_jobs[job_id]
+    job["status"] = "running"
+
+    try:
+        job["response"] = generate_image(input_image, values, job_id)
+        job["status"] = "done"
+    except LookupError as e:
+        job["status"] = "failed"
+        job["error"] = str(e)
+    except Exception:
+        traceback.print_exc()
+        job["status"] = "failed"
+        job["error"] = "Internal Server Error"
+    finally:
+        job["finished_at"] = time.time()
+        job["event"].set()
+
+def expire_gen_jobs():
+
+    expired_before = time.time() - app.config['GEN_JOB_TTL']
+
+    with gen_jobs_lock:
+        for job_id in [
+                job_id for job_id, job in gen_jobs.items()
+                if job.get("finished_at", time.time()) < expired_before
+        ]:
+            del gen_jobs[job_id]
+
+def enqueue_gen_job(input_image, values):
+
+    expire_gen_jobs()
+
+    # read the upload now: the request stream is closed
+    # once the request returns
+    upload = FileStorage(
+        stream=io.BytesIO(input_image.read()),
+        filename=input_image.filename
+    )
+
+    with gen_jobs_lock:
+
+        pending = [
+            job for job in gen_jobs.values()
+            if job["status"] in ("queued", "running")
+        ]
+        if len(pending) >= app.config['GEN_QUEUE_SIZE']:
+            return None
+
+        job_id = uuid.uuid4().hex
+        gen_jobs[job_id] = {
+            "id": job_id,
+            "status": "queued",
+            "created_at": time.time(),
+            "event": threading.Event()
+        }
+
+    gen_executor.submit(run_gen_job, job_id, upload, values)
+
+    return job_id
+
+def gen_job_status(job):
+
+    status = {
+        "id": job["id"],
+        "status": job["status"]
+    }
+
+    if job["status"] == "done":
+        status["image_url"] = f"/jobs/{job['id']}/image"
+        status["response_id"] = job["response"]["id"]
+
+    if job["status"] == "failed":
+        status["error"] = job["error"]
+
+    return status
+
+@app.route("/gen", methods=['POST'])
+def gen_image():
+
+    if 'image' not in request.files:
+        return "Bad Request", 400
+
+    input_image = request.files['image']
+    values = request.values.to_dict()
+
+    # responses are indexed by client for /keep
+    values.setdefault("client", request.remote_addr)
+
+    # job queue mode: return a job id right away
+    if values.get("async") in ("1", "true"):
+
+        job_id = enqueue_gen_job(input_image, values)
+        if job_id is None:
+            return "Too Many Requests", 429
+
+        return jsonify(gen_job_status(gen_jobs[job_id])), 202
+
+    try:
+
+        response = generate_image(input_image, values)
+
+        image_response = send_file(
+            io.BytesIO(response["png"]),
+            mimetype="image/png",
+            download_name=response["filename"]
+        )
+        image_response.headers["X-Response-Id"] = response["id"]
+
+        return image_response
+
+    except LookupError as e:
+        return str(e), 404
+
     # TODO print exception stacktrace
     except RuntimeError as e:
         traceback.print_exc()
         return "Internal Server Error", 500
 
+@app.route("/jobs/<job_id>")
+def gen_job(job_id):
+
+    job = gen_jobs.get(job_id)
+    if job is None:
+        return "Job not found", 404
+
+    # long-poll: wait until the job is finished, at most `wait` seconds
+    wait = min(
+        request.args.get("wait", 0, type=float),
+        app.config['GEN_MAX_WAIT']
+    )
+    if wait > 0:
+        job["event"].wait(wait)
+
+    return jsonify(gen_job_status(job))
+
+@app.route("/jobs/<job_id>/image")
+def gen_job_image(job_id):
+
+    job = gen_jobs.get(job_id)
+    if job is None:
+        return "Job not found", 404
+
+    if job["status"] != "done":
+        return jsonify(gen_job_status(job)), 409
+
+    return send_file(
+        io.BytesIO(job["response"]["png"]),
+        mimetype="image/png",
+        download_name=job["response"]["filename"]
+    )
+
 @app.route("/prompts")
 def prompts():
-    return jsonify(config["prompts"])
+
+    # pre-serialised, 304 when the client already has this version
+    response = app.response_class(
+        config_index["prompts_json"],
+        mimetype="application/json"
+    )
+    response.set_etag(config_index["prompts_etag"])
+
+    return response.make_conditional(request)
 
 @app.route("/keep")
 def publish_image():
 
-    # Add latest response file to git repo index
-    latest_response_path = max(
-        [
-            os.path.join(app.config['UPLOAD_FOLDER'], f)
-            for f in os.listdir(app.config['UPLOAD_FOLDER'])
-            if f.endswith('_response.png')
-        ]
-        , key=os.path.getctime)
-    filename = os.path.basename(latest_response_path)
+    # Response to publish: by id, latest of a client, or latest of all
+    response = response_index.get(
+        response_id=request.args.get("id"),
+        client=request.args.get("client")
+    )
+    if response is None:
+        return "Response not found", 404
 
-    destination_path = os.path.join(app.config['GALLERY_FOLDER'], os.path.basename(latest_response_path))
-    shutil.copy(latest_response_path, destination_path)
+    filename = response["filename"]
 
-    try:
-        subprocess.run(['git', 'add', destination_path], check=True)
-        subprocess.run(['git', 'commit', '-m', "publish: add latest response"], check=True)
-        subprocess.run(['git', 'push', 'origin'], check=True)
-    except Exception as e:
-        app.logger.error("error while keeping latest generated image inside git repository: %s", e)
+    # committed and pushed in the background, with other kept images
+    gallery_publisher.publish(filename, response["png"])
 
-    return f"https://raw.githubusercontent.com/alx/api-call-matrix/refs/heads/main/gallery/{filename}"
+    return app.config['GALLERY_URL'].format(filename=filename)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class GalleryPublisher:
+    """
+    Publish kept images to the gallery of a git repository from a
+    background thread: images are coalesced into one commit per
+    `window` seconds or `max_images` images, then pushed with retries.
+
+    repo_folder and remote can point to any repository, e.g. a clone
+    of a local bare repository in tests.
+    """
+
+    def __init__(
+            self,
+            repo_folder,
+            gallery_folder,
+            remote="origin",
+            window=30,
+            max_images=10,
+            push_retries=3,
+            retry_delay=5
+    ):
+
+        self.repo_folder = repo_folder
+        self.gallery_folder = gallery_folder
+        self.remote = remote
+        self.window = window
+        self.max_images = max_images
+        self.push_retries = push_retries
+        self.retry_delay = retry_delay
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def publish(self, filename, png):
+        """
+        Queue png to be published as gallery/filename.
+        """
+
+        self.queue.put((filename, png))
+
+    def flush(self):
+        """
+        Block until every queued image is committed and pushed.
+        """
+
+        self.queue.join()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+
+        while True:
+
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            # coalesce the images kept during the window
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            stop = False
+
+            while len(batch) < self.max_images:
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+                if item is None:
+                    stop = True
+                    break
+
+                batch.append(item)
+
+            try:
+                self.commit_and_push(batch)
+            except Exception as e:
+                logger.error("error while keeping generated images inside git repository: %s", e)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+            if stop:
+                self.queue.task_done()
+                return
+
+    def git(self, *args):
+
+        return subprocess.run(
+            ['git', '-C', self.repo_folder, *args],
+            check=True,
+            capture_output=True
+        )
+
+    def has_staged_changes(self, paths):
+
+        diff = subprocess.run(
+            ['git', '-C', self.repo_folder, 'diff', '--cached', '--quiet', '--', *paths],
+            capture_output=True
+        )
+
+        return diff.returncode != 0
+
+    def commit_and_push(self, batch):
+
+        os.makedirs(self.gallery_folder, exist_ok=True)
+
+        paths = []
+        for filename, png in batch:
+
+            destination_path = os.path.join(self.gallery_folder, filename)
+            with open(destination_path, "wb") as f:
+                f.write(png)
+
+            paths.append(os.path.relpath(destination_path, self.repo_folder))
+
+        self.git('add', '--', *paths)
+
+        # images kept again unchanged: nothing to commit
+        if self.has_staged_changes(paths):
+            self.git(
+                'commit',
+                '-m', f"publish: add {len(paths)} response{'s' if len(paths) > 1 else ''}",
+                '--', *paths
+            )
+
+        # a failed push is retried, and otherwise
+        # goes out with the next batch
+        for attempt in range(self.push_retries + 1):
+            try:
+                self.git('push', self.remote)
+                logger.info(f"✔ published {len(paths)} images")
+                return
+            except subprocess.CalledProcessError as e:
+                logger.error(f"❌ git push failed ({attempt + 1}/{self.push_retries + 1}): {e.stderr}")
+                if attempt < self.push_retries:
+                    time.sleep(self.retry_delay * 2 ** attempt)
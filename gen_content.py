@@ -2,12 +2,25 @@
 #!/usr/bin/env python3
 import json
 import os
+import hashlib
 from datetime import datetime
 import jinja2
 
+from gen_thumbnails import (
+    generate_thumbnails,
+    find_results,
+    thumbnail_settings,
+    thumbnail_path,
+    srcset,
+)
+from blob_store import BlobStore, DEFAULT_BLOBS_ROOT, strip_blobs
+
 # Config data
 config_filepath = 'config.json'
 
+# Build manifest used by the incremental mode
+DEFAULT_CONTENT_MANIFEST_PATH = './.cache/content_manifest.json'
+
 # Templates
 env = jinja2.Environment(
     loader=jinja2.FileSystemLoader(searchpath="./templates/"),
@@ -17,24 +30,33 @@ env = jinja2.Environment(
 template_sdrun = env.get_template("sdrun.html")
 template_prompt = env.get_template("prompt.html")
 
-####
-####
+def templates_hash():
 
-def content_path(filename="_index.html"):
+    digest = hashlib.sha256()
+    for template in [template_sdrun, template_prompt]:
+        with open(template.filename, "rb") as f:
+            digest.update(f.read())
 
-    config = load_config()
+    return digest.hexdigest()
 
-    return os.path.join(config["content_root"], filename)
+# sections are rendered again when a template changes
+TEMPLATES_HASH = templates_hash()
 
-def sd_run_to_content(sd_run):
+def inputs_hash(*inputs):
 
-    config = load_config()
+    digest = hashlib.sha256(TEMPLATES_HASH.encode())
+    digest.update(json.dumps(inputs, sort_keys=True, default=str).encode())
 
-    if "base64_placeholder" not in config:
-        raise KeyError(f"❌ base64_placeholder not found in config file: {config_filepath}")
+    return digest.hexdigest()
 
-    if "save_json" not in config:
-        raise KeyError(f"❌ save_json not found in config file: {config_filepath}")
+####
+####
+
+def content_path(config, filename="_index.html"):
+
+    return os.path.join(config["content_root"], filename)
+
+def sd_run_to_content(sd_run, config, prompts):
 
     slug = sd_run['slug_id']
     sd_params = sd_run["params"]
@@ -46,12 +68,13 @@ def sd_run_to_content(sd_run):
     for control_index, control_data in enumerate(controlnet_args):
         categories.append(control_data['module'])
 
-        if (
-                config["save_json"]
-                and "image" in control_data
-        ):
-            # replace base64 image by placeholder
-            control_data["image"] = config["base64_placeholder"]
+    # base64 images are replaced by references to the blob store,
+    # like in the result json files
+    sd_params = strip_blobs(
+        sd_params,
+        BlobStore(config.get("blobs_root", DEFAULT_BLOBS_ROOT)),
+        relative_to="./static"
+    )
 
     content = template_sdrun.render({
         "slug": sd_run["slug_id"],
@@ -60,35 +83,31 @@ def sd_run_to_content(sd_run):
         "sd_params": json.dumps(sd_params, sort_keys=False, indent=2)
     })
 
-    for prompt in sd_run["prompts"]:
+    for prompt in prompts:
         content += prompt
 
     return content
 
-# Function to create an content file for each prompt result
-def prompt_to_content(prompt_data, result_output_paths):
-
-    config = load_config()
-
-    if "base64_placeholder" not in config:
-        raise KeyError(f"❌ base64_placeholder not found in config file: {config_filepath}")
+# Function to create an content file for each prompt result,
+# links being prefixed with root ("/" on pages below the site root)
+def prompt_to_content(prompt_data, result_output_paths, config, root=""):
 
     # Extract required data
     prompt_title = prompt_data["prompt"]
 
-    # Prepare the content of the org file
-    image_paths = [
-        image_path.replace("./static/", "")
-        for image_path in result_output_paths
-    ]
+    # Small previews in the page, full size image in photoswipe
+    settings = thumbnail_settings(config)
+    smallest_width = min(settings["widths"])
 
     img_list = []
-    for img_path in image_paths:
-        json_path = img_path.replace(".png", ".json")
+    for result_output_path in result_output_paths:
+        img_path = root + result_output_path.replace("./static/", "")
         img_list.append({
             "basename": os.path.basename(img_path),
             "path": img_path,
             "json_path": img_path.replace(".png", ".json"),
+            "thumbnail": root + thumbnail_path(result_output_path, smallest_width, settings).replace("./static/", ""),
+            "srcset": srcset(result_output_path, settings, root),
             "width": prompt_data["width"],
             "height": prompt_data["height"]
         })
@@ -98,12 +117,7 @@ def prompt_to_content(prompt_data, result_output_paths):
         "img_list": img_list
     })
 
-def process_prompt(prompt_data, output_dir):
-
-    config = load_config()
-
-    if "sources_root" not in config:
-        raise KeyError(f"❌ sources_root not found in config file: {config_filepath}")
+def list_source_basenames(config):
 
     if not os.path.exists(config["sources_root"]):
         raise OSError(f"❌ Sources root folder not found: {config['sources_root']}")
@@ -119,45 +133,74 @@ def process_prompt(prompt_data, output_dir):
     if len(source_files) == 0:
         raise ValueError(f"❌ Not enough source files ({len(source_files)}).")
 
+    # Get the basename of the source files (without extension)
+    return [
+        os.path.basename(source_file).split('.')[0]
+        for source_file in source_files
+    ]
+
+def process_prompt(prompt_data, output_dir, config, source_basenames, cached_section={}):
+
+    # List the results once instead of checking every expected file
+    results = {
+        entry.name: (entry.stat().st_mtime_ns, entry.stat().st_size)
+        for entry in os.scandir(output_dir)
+        if entry.is_file()
+    }
+
     # List to keep paths of the saved images
     result_output_paths = []
+    result_stats = []
 
     # For each prompt, use multiple source files
-    for source_file in source_files:
-
-        # Get the basename of the source file (without extension)
-        source_basename = os.path.basename(source_file).split('.')[0]
+    for source_basename in source_basenames:
 
         # Set the image path where the result will be saved,
         # using the source file basename
-        output_path = os.path.join(output_dir, f"{source_basename}.png")
+        output_filename = f"{source_basename}.png"
 
         # check if output file exists
         # before to insert it in results
-        if os.path.exists(output_path):
-            result_output_paths.append(output_path)
-
-    # Create content with the list of result images
-    return prompt_to_content(prompt_data, result_output_paths)
+        if output_filename in results:
+            result_output_paths.append(os.path.join(output_dir, output_filename))
+            result_stats.append([output_filename, *results[output_filename]])
+
+    # Render again only if the prompt or its results changed
+    section_hash = inputs_hash(prompt_data, result_stats, thumbnail_settings(config))
+    if cached_section.get("hash") == section_hash and "page_content" in cached_section:
+        return cached_section
+
+    # Create content with the list of result images, for _index.html
+    # and for the run page served at /runs/<slug_id>/
+    return {
+        "hash": section_hash,
+        "content": prompt_to_content(prompt_data, result_output_paths, config),
+        "page_content": prompt_to_content(prompt_data, result_output_paths, config, root="/")
+    }
 
 def process_sd_run(
         sd_run,
         prompts,
+        config,
+        source_basenames,
+        cached_run={},
         top_level_positive="",
         top_level_negative="",
 ):
 
-    config = load_config()
-
-    if "results_root" not in config:
-        raise KeyError(f"❌ results_root not found in config file: {config_filepath}")
-
     # Set the sd_run path where the result will be saved,
     # using the sd_run slug id
     sd_param_dir = os.path.join(config["results_root"], sd_run["slug_id"])
     os.makedirs(sd_param_dir, exist_ok=True)
 
     sd_run["prompts"] = []
+    sd_run["page_prompts"] = []
+
+    # Build manifest entry of this sd_run
+    cached_sections = cached_run.get("prompts", {})
+    run_entry = {
+        "prompts": {}
+    }
 
     # Iterate through the prompts and corresponding source files, and make the POST request
     for prompt_index, prompt_data in enumerate(prompts):
@@ -188,14 +231,76 @@ def process_sd_run(
         output_dir = os.path.join(sd_param_dir, prompt_data["slug_id"])
         os.makedirs(output_dir, exist_ok=True)
 
-        prompt_content = process_prompt(prompt_data, output_dir)
+        section = process_prompt(
+            prompt_data,
+            output_dir,
+            config,
+            source_basenames,
+            cached_sections.get(prompt_data["slug_id"], {})
+        )
+        run_entry["prompts"][prompt_data["slug_id"]] = section
+
+        if len(section["content"]) > 0:
+            sd_run["prompts"].append(section["content"])
+            sd_run["page_prompts"].append(section["page_content"])
+
+    # Render again only if the sd_run params or a prompt section changed
+    run_entry["hash"] = inputs_hash(
+        sd_run["slug_id"],
+        sd_run["params"],
+        config["save_json"],
+        [section["hash"] for section in run_entry["prompts"].values()]
+    )
+
+    if cached_run.get("hash") == run_entry["hash"] and "page_content" in cached_run:
+        run_entry["content"] = cached_run["content"]
+        run_entry["page_content"] = cached_run["page_content"]
+    else:
+        run_entry["content"] = sd_run_to_content(sd_run, config, sd_run["prompts"])
+        run_entry["page_content"] = sd_run_to_content(sd_run, config, sd_run["page_prompts"])
 
-        if len(prompt_content) > 0:
-            sd_run["prompts"].append(prompt_content)
+    return run_entry
 
-    content = sd_run_to_content(sd_run)
+def load_content_manifest(manifest_path):
 
-    return content
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def write_file(path, content):
+
+    # write then rename: hugo never sees a partial file
+    directory = os.path.dirname(path)
+    if len(directory) > 0:
+        os.makedirs(directory, exist_ok=True)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def run_page_content(sd_run, content):
+
+    front_matter = json.dumps({"title": sd_run["slug_id"]}, indent=2)
+
+    return f"{front_matter}\n{content}"
+
+def remove_stale_run_pages(config, manifest):
+
+    runs_dir = content_path(config, "runs")
+    if not os.path.isdir(runs_dir):
+        return
+
+    for entry in os.scandir(runs_dir):
+
+        slug_id, extension = os.path.splitext(entry.name)
+        if extension != ".html" or slug_id in manifest:
+            continue
+
+        os.remove(entry.path)
+        print(f"✔ gen_content - sd_run - {slug_id} - removed")
 
 def load_config():
 
@@ -205,54 +310,113 @@ def load_config():
     with open(config_filepath, 'r') as f:
         config = json.load(f)
 
+    validate_config(config)
+
     return config
 
+# Required config keys and their expected type
+CONFIG_SCHEMA = {
+    "runs": list,
+    "prompts": list,
+    "sources_root": str,
+    "results_root": str,
+    "content_root": str,
+    "save_content": bool,
+    "save_json": bool,
+    "positive": str,
+    "negative": str,
+}
+
+def validate_config(config):
+
+    for key, key_type in CONFIG_SCHEMA.items():
+
+        if key not in config:
+            raise KeyError(f"❌ {key} not found in config file: {config_filepath}")
+
+        if not isinstance(config[key], key_type):
+            raise TypeError(f"❌ {key} must be a {key_type.__name__} in config file: {config_filepath}")
+
 def main():
 
+    # Config is loaded and validated once, then handed to every function
     config = load_config()
     content = ""
 
-    if "runs" not in config:
-        raise KeyError(f"❌ runs not found in config file: {config_filepath}")
+    # Incremental mode: keep rendered sections in a build manifest,
+    # and only render and write what changed since the last build
+    incremental = config.get("incremental_content", False)
+    manifest_path = config.get("content_manifest_path", DEFAULT_CONTENT_MANIFEST_PATH)
 
-    elif "prompts" not in config:
-        raise KeyError(f"❌ prompts not found in config file: {config_filepath}")
+    previous_manifest = {}
+    if incremental:
+        previous_manifest = load_content_manifest(manifest_path)
 
-    elif "save_content" not in config:
-        raise KeyError(f"❌ save_content not found in config file: {config_filepath}")
-
-    else:
+    manifest = {}
+    source_basenames = list_source_basenames(config)
 
-        enabled_runs = [
-            r for r in config["runs"]
-            if r["enabled"]
-        ]
+    # Thumbnails of new or updated results, in a process pool
+    thumbnail_count = generate_thumbnails(find_results(config), config)
+    print(f"✔ gen_content - {thumbnail_count} thumbnails generated")
 
-        enabled_prompts = [
-            p for p in config["prompts"]
-            if p["enabled"]
-        ]
+    enabled_runs = [
+        r for r in config["runs"]
+        if r["enabled"]
+    ]
 
-        # Start runs
-        for sd_run in enabled_runs:
+    enabled_prompts = [
+        p for p in config["prompts"]
+        if p["enabled"]
+    ]
 
-            print(f"✔ gen_content - sd_run - {sd_run['slug_id']}")
+    # Start runs
+    for sd_run in enabled_runs:
+
+        print(f"✔ gen_content - sd_run - {sd_run['slug_id']}")
+
+        cached_run = previous_manifest.get(sd_run["slug_id"], {})
+        run_entry = process_sd_run(
+            sd_run,
+            enabled_prompts,
+            config,
+            source_basenames,
+            cached_run,
+            config["positive"],
+            config["negative"],
+        )
+        manifest[sd_run["slug_id"]] = run_entry
+        content += run_entry["content"]
+
+        # one content file per sd_run, only written when it changed,
+        # so hugo only rebuilds the pages of the modified runs
+        run_path = content_path(config, os.path.join("runs", f"{sd_run['slug_id']}.html"))
+        if incremental and (
+                cached_run.get("hash") != run_entry["hash"]
+                or not os.path.exists(run_path)
+        ):
+            write_file(run_path, run_page_content(sd_run, run_entry["page_content"]))
+            print(f"✔ gen_content - sd_run - {sd_run['slug_id']} - updated")
 
-            content += process_sd_run(
-                sd_run,
-                enabled_prompts,
-                config["positive"],
-                config["negative"],
-            )
+    # pages of disabled or renamed runs must not be published anymore
+    if incremental:
+        remove_stale_run_pages(config, manifest)
 
     if "save_content" and len(content) > 0:
 
-        if "content_root" not in config:
-            raise KeyError(f"❌ content_root not found in config file: {config_filepath}")
+        index_hash = inputs_hash([run_entry["hash"] for run_entry in manifest.values()])
 
         # Write the content to the content file
-        with open(content_path(), "w+") as f:
-            f.writelines(content)
+        if (
+                not incremental
+                or previous_manifest.get("_index", {}).get("hash") != index_hash
+                or not os.path.exists(content_path(config))
+        ):
+            write_file(content_path(config), content)
+
+        manifest["_index"] = {"hash": index_hash}
+
+        if incremental:
+            write_file(manifest_path, json.dumps(manifest))
 
         print(f"✔ gen_content DONE")
 
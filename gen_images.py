@@ -3,116 +3,178 @@ import json
 import os
 from datetime import datetime
 import itertools
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import shutil
 
+import requests
 import webuiapi
 from webuiapi import b64_img, raw_b64_img
 
 import PIL
 from PIL import Image, PngImagePlugin
 
+from a1111_pool import load_pool
+from interrogator_cache import open_cache
+from source_store import SourceStore
+from job_manifest import (
+    JobManifest,
+    DEFAULT_MANIFEST_PATH,
+    interrogator_settings,
+    job_hash,
+    request_fingerprint,
+)
+from payload_template import build_template, specialise
+from event_log import EventLog, DEFAULT_EVENT_LOG_PATH, timed
+from blob_store import BlobStore, DEFAULT_BLOBS_ROOT, blob_bytes, blob_hash, strip_blobs
+
 # Config data
 config_filepath = 'config.json'
 
-def process_interrogator(
-        input_image
+def post_interrogator(
+        image_b64,
+        interrogator_url,
+        interrogator_config,
+        pool,
+        event_log
 ):
-    config = load_config()
-    api = load_api(config)
-    use_async = False
-
-    interrogator_config = config["api"]["interrogator"]
-    interrogator_prompt = ""
 
     interrogator_params = {
-        "image": b64_img(input_image),
+        "image": image_b64,
         "clip_model_name": interrogator_config["clip_model_name"],
         "mode": interrogator_config["mode"]
     }
 
-    interrogator_url = f'http://{interrogator_config["host"]}:{interrogator_config["port"]}/{interrogator_config["prompt_endpoint"]}'
+    stats = {}
+    status = "failed"
 
     try:
-
-        interrogator_response = api.post_and_get_api_result(
+        # the interrogator is not an a1111 backend: its errors
+        # must not mark the backends down
+        interrogator_response = pool.post_external(
             interrogator_url,
             interrogator_params,
-            use_async
+            stats
         )
 
         # Check if an exception occured
-        response_prompt = interrogator_response.json["prompt"]
+        response_prompt = interrogator_response["prompt"]
         if "Exception" in response_prompt:
             raise RuntimeError
 
-        else:
+        status = "done"
 
-            # Get TOP results from prompt
-            if "sliced_top_prompts" in interrogator_config:
+    finally:
+        event_log.log("interrogate", status=status, **stats)
 
-                interrogator_prompt = ",".join(itertools.islice(
-                    response_prompt.split(","),
-                    interrogator_config["sliced_top_prompts"]
-                ))
+    return response_prompt
 
-            else:
+def process_interrogator(
+        source,
+        pool,
+        config,
+        event_log
+):
+    interrogator_config = config["api"]["interrogator"]
+    interrogator_prompt = ""
 
-                interrogator_prompt = response_prompt
+    # Interrogation only depends on the image and interrogator settings
+    interrogator_cache = open_cache(interrogator_config)
+    cache_key = None
+    response_prompt = None
 
-    except RuntimeError:
-        print(f"❌ interrogator runtime error")
+    if interrogator_cache is not None:
+        cache_key = interrogator_cache.key(
+            source.hash(),
+            interrogator_config["clip_model_name"],
+            interrogator_config["mode"]
+        )
+        response_prompt = interrogator_cache.get(cache_key)
 
-    print(interrogator_prompt)
-    return interrogator_prompt
+    interrogator_url = f'http://{interrogator_config["host"]}:{interrogator_config["port"]}/{interrogator_config["prompt_endpoint"]}'
 
-def process_source(
-        prompt_data,
-        input_image,
-        output_path
-):
+    try:
 
-    config = load_config()
-    api = load_api(config)
-    use_async = False
+        if response_prompt is None:
+            response_prompt = post_interrogator(
+                source.b64(),
+                interrogator_url,
+                interrogator_config,
+                pool,
+                event_log
+            )
 
-    controlnet_units = []
+            if interrogator_cache is not None:
+                interrogator_cache.set(cache_key, response_prompt)
 
-    origin_prompt = prompt_data["prompt"]
+        # Get TOP results from prompt
+        if "sliced_top_prompts" in interrogator_config:
 
-    for control in prompt_data["alwayson_scripts"]["ControlNet"]["args"]:
+            interrogator_prompt = ",".join(itertools.islice(
+                response_prompt.split(","),
+                interrogator_config["sliced_top_prompts"]
+            ))
 
-        # replace placeholder in prompt_data controlnets
-        if "image" in control:
-            control["image"] = raw_b64_img(input_image)
+        else:
 
-        controlnet_units.append(control)
+            interrogator_prompt = response_prompt
 
-    prompt_data["controlnet_units"] = controlnet_units
+    except RuntimeError:
+        print(f"❌ interrogator runtime error")
+    except requests.exceptions.RequestException as e:
+        print(f"❌ interrogator unreachable - {e}")
 
-    if "reactor" in prompt_data:
-        # include ReActor extension parameters in prompt_data
-        reactor = webuiapi.ReActor(
-            img=input_image,
-            source_faces_index = "0,1,2,3", #2 Comma separated face number(s) from swap-source image
-            faces_index = "0,1,2,3", #3 Comma separated face number(s) for target image (result)
-            upscaler_name =  "None",# None, # "R-ESRGAN 4x+", #8 Upscaler (type 'None' if doesn't need), see full list here: http://127.0.0.1:7860/sdapi/v1/script-info -> reactor -> sec.8
-            swap_in_source = True,
-            console_logging_level = 2, #13 Console Log Level (0 - min, 1 - med or 2 - max)
-            codeFormer_weight = 1,
-            target_hash_check = True,
-            mask_face = False,
-        )
-        prompt_data["alwayson_scripts"]["reactor"] = {
-            "args": reactor.to_dict()
-        }
+    print(interrogator_prompt)
+    return interrogator_prompt
+
+def reactor_args(input_image):
+
+    # include ReActor extension parameters in prompt_data
+    reactor = webuiapi.ReActor(
+        img=input_image,
+        source_faces_index = "0,1,2,3", #2 Comma separated face number(s) from swap-source image
+        faces_index = "0,1,2,3", #3 Comma separated face number(s) for target image (result)
+        upscaler_name =  "None",# None, # "R-ESRGAN 4x+", #8 Upscaler (type 'None' if doesn't need), see full list here: http://127.0.0.1:7860/sdapi/v1/script-info -> reactor -> sec.8
+        swap_in_source = True,
+        console_logging_level = 2, #13 Console Log Level (0 - min, 1 - med or 2 - max)
+        codeFormer_weight = 1,
+        target_hash_check = True,
+        mask_face = False,
+    )
+
+    return reactor.to_dict()
+
+def process_source(
+        prompt_data,
+        source,
+        output_path,
+        pool,
+        config,
+        stats,
+        event_log
+):
+
+    # prompt_data is the template shared by every job of the prompt:
+    # the payload only copies what differs for this source,
+    # which is encoded once and shared by every job
+    fields = {}
 
     if "interrogator" in config["api"]:
-        interrogator_prompt = process_interrogator(input_image)
+        interrogator_prompt = process_interrogator(source, pool, config, event_log)
 
-        prompt_data["prompt"] = ",".join([
+        fields["prompt"] = ",".join([
             interrogator_prompt,
             prompt_data["prompt"]
         ])
 
+    payload = specialise(
+        prompt_data,
+        control_image=source.raw_b64(),
+        reactor_args=source.memo("reactor", reactor_args) if "reactor" in prompt_data else None,
+        **fields
+    )
+
     try:
 
 
@@ -123,42 +185,116 @@ def process_source(
         #
         #
         #####
-        response = api.post_and_get_api_result(
-            f"{api.baseurl}/txt2img",
-            prompt_data,
-            use_async
+        backend, response = pool.post(
+            "/txt2img",
+            payload,
+            stats
         )
 
-        # Save the image
-        response.image.save(output_path)
+        # Save the image: write then rename, so output_path
+        # never holds a half-written PNG
+        with timed(stats["timings"], "save"):
+            tmp_path = f"{output_path}.tmp"
+
+            # the PNG sent by a1111 is written as is, the result
+            # json then references it instead of a copy of its base64
+            image_data = blob_bytes(response.json["images"][0])
+            if image_data is not None and image_data.startswith(b"\x89PNG"):
+                with open(tmp_path, "wb") as f:
+                    f.write(image_data)
+                stats["output_hash"] = blob_hash(image_data)
+            else:
+                response.image.save(tmp_path, format="PNG")
 
-        # Restore prompt if modified by interrogator
-        prompt_data["prompt"] = origin_prompt
+            os.replace(tmp_path, output_path)
 
-        return response.json
+        return response.json, backend
 
-    except RuntimeError:
-        print(api.baseurl)
-        print(f"❌ response {response.status_code}")
-        print(f"❌ {image_path}")
+    except RuntimeError as e:
+        print(f"❌ response {e}")
+        print(f"❌ {output_path}")
 
-        return {}
+        return {}, None
 
-def process_prompt(
-        prompt_data,
-        output_dir,
+def process_job(
+        job,
+        pool,
+        config,
+        source_store,
+        manifest,
+        event_log,
+        blob_store
 ):
 
-    config = load_config()
+    # decoded source image, shared with every other job using this file
+    source = source_store.get(job["source_file"])
+
+    manifest.update(job["output_path"], job["input_hash"], "running")
+    start_time = time.monotonic()
 
-    if "sources_root" not in config:
-        raise KeyError(f"❌ sources_root not found in config file: {config_filepath}")
+    # backend, payload hash and timings of the txt2img call
+    stats = {}
+    status = "failed"
 
-    if "placeholder" not in config:
-        raise KeyError(f"❌ placeholder not found in config file: {config_filepath}")
+    print(f"▶     source - {job['label']}")
+    try:
+        result_json, backend = process_source(
+            job["prompt_data"],
+            source,
+            job["output_path"],
+            pool,
+            config,
+            stats,
+            event_log
+        )
 
-    if "save_json" not in config:
-        raise KeyError(f"❌ save_json not found in config file: {config_filepath}")
+        if backend is not None:
+            status = "done"
+
+    finally:
+        event_log.log(
+            "txt2img",
+            job=job["input_hash"],
+            output_path=job["output_path"],
+            status=status,
+            latency=time.monotonic() - start_time,
+            **stats
+        )
+
+    manifest.update(
+        job["output_path"],
+        job["input_hash"],
+        status,
+        backend,
+        time.monotonic() - start_time,
+        job["fingerprint"]
+    )
+
+    # Save the result as json, its base64 images replaced by
+    # references to the output PNG or to the blob store
+    if config["save_json"]:
+
+        known_paths = {}
+        if "output_hash" in stats:
+            known_paths[stats["output_hash"]] = job["output_path"]
+
+        with open(job["json_path"], "w") as f:
+            json.dump(
+                strip_blobs(
+                    result_json,
+                    blob_store,
+                    known_paths,
+                    relative_to=os.path.dirname(job["json_path"])
+                ),
+                f
+            )
+
+def process_prompt(
+        prompt_data,
+        output_dir,
+        config,
+        manifest
+):
 
     if config["save_json"]:
         # Save the request as json
@@ -177,6 +313,12 @@ def process_prompt(
     if len(source_files) == 0:
         raise ValueError(f"❌ Not enough source files ({len(source_files)}).")
 
+    # the prompt sent also depends on the interrogator settings
+    interrogator = interrogator_settings(config)
+
+    # List of jobs to send to the a1111 backends
+    jobs = []
+
     for source_index, source_file in enumerate(source_files):
         # Get the basename of the source file (without extension)
         source_basename = os.path.basename(source_file).split('.')[0]
@@ -185,56 +327,51 @@ def process_prompt(
         # using the source file basename
         output_path = os.path.join(output_dir, f"{source_basename}.png")
 
-        # Check if the image already exists
+        # Check if the image was already generated from the same inputs
         # if yes: skip the HTTP POST request
-        if os.path.exists(output_path) and not config["force_generate"]:
+        source_hash = manifest.source_hash(source_file)
+        input_hash = job_hash(prompt_data, source_hash, interrogator)
+
+        if manifest.is_done(output_path, input_hash) and not config["force_generate"]:
             print(f"▶     source - [{source_index + 1}/{len(source_files)}] - {source_basename} - exists")
             continue
 
-        # move the source file to PIL Image
-        input_image = Image.open(source_file)
-
-        print(f"▶     source - [{source_index + 1}/{len(source_files)}] - {source_basename}")
-        result_json = process_source(
-            prompt_data,
-            input_image,
-            output_path
-        )
-
-        # Save the result as json
-        if config["save_json"]:
-
-            json_path = os.path.join(
-                output_dir,
-                f"{source_basename}.json"
-            )
+        # jobs share the prompt_data template, never modified
+        jobs.append({
+            "prompt_data": prompt_data,
+            "source_file": source_file,
+            "input_hash": input_hash,
+            "fingerprint": request_fingerprint(prompt_data, source_hash, interrogator),
+            "output_path": output_path,
+            "json_path": os.path.join(output_dir, f"{source_basename}.json"),
+            "label": f"{prompt_data['slug_id']} - {source_basename}"
+        })
 
-            with open(json_path, "w") as f:
-                json.dump(result_json, f)
+    return jobs
 
 def process_sd_run(
         sd_run,
         prompts,
+        config,
+        manifest,
         top_level_positive="",
         top_level_negative="",
 ):
 
-    config = load_config()
-
-    if "results_root" not in config:
-        raise KeyError(f"❌ results_root not found in config file: {config_filepath}")
-
-
     # Set the sd_run path where the result will be saved,
     # using the sd_run slug id
     sd_param_dir = os.path.join(config["results_root"], sd_run["slug_id"])
     os.makedirs(sd_param_dir, exist_ok=True)
 
-    # Iterate through the prompts and corresponding source files, and make the POST request
+    # List of jobs for every prompt and source file of this sd_run
+    jobs = []
+
+    # Iterate through the prompts and corresponding source files
     for prompt_index, prompt_data in enumerate(prompts):
 
-        # populate prompt_data with sd_run
-        prompt_data = prompt_data | sd_run["params"]
+        # populate prompt_data with sd_run, as a template
+        # deep copied once from the config dicts
+        prompt_data = build_template(prompt_data, sd_run["params"])
         prompt_data["prompt"] = ""
         prompt_data["negative_prompt"] = ""
 
@@ -264,11 +401,15 @@ def process_sd_run(
             prompt_data["reactor"] = True
 
         print(f"▶   prompt - [{prompt_index + 1}/{len(prompts)}] - {prompt_data['slug_id']}")
-        process_prompt(
+        jobs += process_prompt(
             prompt_data,
-            output_dir
+            output_dir,
+            config,
+            manifest
         )
 
+    return jobs
+
 def load_config():
 
     if not os.path.exists(config_filepath):
@@ -277,49 +418,177 @@ def load_config():
     with open(config_filepath, 'r') as f:
         config = json.load(f)
 
+    validate_config(config)
+
     return config
 
-def load_api(config):
+# Required config keys and their expected type
+CONFIG_SCHEMA = {
+    "runs": list,
+    "prompts": list,
+    "api": dict,
+    "sources_root": str,
+    "results_root": str,
+    "placeholder": str,
+    "save_json": bool,
+    "positive": str,
+    "negative": str,
+}
+
+def validate_config(config):
 
-    if "api" not in config:
-        raise KeyError(f"❌ api not found in config file: {config_filepath}")
+    for key, key_type in CONFIG_SCHEMA.items():
 
-    if "a1111" not in config["api"]:
-        raise KeyError(f"❌ a1111 not found in config file: {config_filepath}")
+        if key not in config:
+            raise KeyError(f"❌ {key} not found in config file: {config_filepath}")
 
-    return webuiapi.WebUIApi(**config["api"]["a1111"])
+        if not isinstance(config[key], key_type):
+            raise TypeError(f"❌ {key} must be a {key_type.__name__} in config file: {config_filepath}")
+
+    config.setdefault("force_generate", False)
+
+def link_output(existing_path, output_path):
+
+    # hardlink when possible, copy across filesystems
+    tmp_path = f"{output_path}.tmp"
+    try:
+        os.link(existing_path, tmp_path)
+    except OSError:
+        shutil.copyfile(existing_path, tmp_path)
+
+    os.replace(tmp_path, output_path)
+
+def reuse_output(job, config, manifest, run_started_at):
+    """
+    Reuse the output of an identical request with a fixed seed
+    instead of calling a1111 again. Return True if reused.
+    With force_generate, only outputs generated by this run are reused.
+    """
+
+    if job["fingerprint"] is None:
+        return False
+
+    existing_path = manifest.find_output(
+        job["fingerprint"],
+        job["output_path"],
+        run_started_at if config["force_generate"] else 0
+    )
+    if existing_path is None:
+        return False
+
+    link_output(existing_path, job["output_path"])
+
+    existing_json_path = os.path.splitext(existing_path)[0] + ".json"
+    if config["save_json"] and os.path.exists(existing_json_path):
+        link_output(existing_json_path, job["json_path"])
+
+    manifest.update(
+        job["output_path"],
+        job["input_hash"],
+        "done",
+        fingerprint=job["fingerprint"]
+    )
+
+    print(f"▶     source - {job['label']} - reused {existing_path}")
+    return True
+
+def run_jobs(jobs, config, manifest):
+
+    if len(jobs) == 0:
+        return
+
+    run_started_at = time.time()
+    pool = load_pool(config, config_filepath)
+    source_store = SourceStore()
+
+    # JSONL log of every backend call, null event_log_path disables it
+    event_log = EventLog(
+        config.get("event_log_path", DEFAULT_EVENT_LOG_PATH),
+        max_bytes=config.get("event_log_max_bytes", 10 * 1024 ** 2),
+        backups=config.get("event_log_backups", 3)
+    )
+
+    # images of the result json files, stored once by content hash
+    blob_store = BlobStore(config.get("blobs_root", DEFAULT_BLOBS_ROOT))
+
+    done_counter = {
+        "count": 0,
+        "lock": threading.Lock()
+    }
+
+    def run_job(job):
+
+        try:
+            if not reuse_output(job, config, manifest, run_started_at):
+                process_job(job, pool, config, source_store, manifest, event_log, blob_store)
+        except Exception as e:
+            print(f"❌ {job['label']} - {e}")
+        finally:
+            with done_counter["lock"]:
+                done_counter["count"] += 1
+                print(f"✔ job - [{done_counter['count']}/{len(jobs)}] - {job['label']}")
+
+    print(f"▶ jobs - {len(jobs)} jobs on {len(pool.backends)} backends ({pool.capacity()} slots)")
+
+    # the pool blocks each call until its least-loaded
+    # healthy backend has a free slot
+    # identical requests in this batch wait for the first one
+    # to be generated, then reuse its output
+    primary_jobs = []
+    duplicate_jobs = []
+    fingerprints = set()
+
+    for job in jobs:
+        if job["fingerprint"] is not None and job["fingerprint"] in fingerprints:
+            duplicate_jobs.append(job)
+        else:
+            fingerprints.add(job["fingerprint"])
+            primary_jobs.append(job)
+
+    with ThreadPoolExecutor(max_workers=pool.capacity()) as executor:
+        list(executor.map(run_job, primary_jobs))
+        list(executor.map(run_job, duplicate_jobs))
+
+    pool.stop()
+    event_log.close()
+
+    print(f"✔ source store - {source_store.report()}")
 
 def main():
 
+    # Config is loaded and validated once, then handed to every function
     config = load_config()
 
-    if "runs" not in config:
-        raise KeyError(f"❌ runs not found in config file: {config_filepath}")
+    # Resume from previous runs: only jobs whose inputs changed
+    # since their output was generated are sent again
+    manifest = JobManifest(config.get("manifest_path", DEFAULT_MANIFEST_PATH))
 
-    elif "prompts" not in config:
-        raise KeyError(f"❌ prompts not found in config file: {config_filepath}")
+    enabled_runs = [
+        r for r in config["runs"]
+        if r["enabled"]
+    ]
 
-    else:
+    enabled_prompts = [
+        p for p in config["prompts"]
+        if p["enabled"]
+    ]
 
-        enabled_runs = [
-            r for r in config["runs"]
-            if r["enabled"]
-        ]
+    # Flatten the runs x prompts x sources matrix into jobs
+    jobs = []
 
-        enabled_prompts = [
-            p for p in config["prompts"]
-            if p["enabled"]
-        ]
+    for sd_run_index, sd_run in enumerate(enabled_runs):
 
-        for sd_run_index, sd_run in enumerate(enabled_runs):
+        print(f"▶ sd_run - [{sd_run_index + 1}/{len(enabled_runs)}] - {sd_run['slug_id']}")
+        jobs += process_sd_run(
+            sd_run,
+            enabled_prompts,
+            config,
+            manifest,
+            config["positive"],
+            config["negative"],
+        )
 
-            print(f"▶ sd_run - [{sd_run_index + 1}/{len(enabled_runs)}] - {sd_run['slug_id']}")
-            process_sd_run(
-                sd_run,
-                enabled_prompts,
-                config["positive"],
-                config["negative"],
-            )
+    run_jobs(jobs, config, manifest)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+# Config data
+config_filepath = 'config.json'
+
+# Thumbnail defaults, overridden by config.json
+DEFAULT_THUMBNAILS_ROOT = "./static/img/thumbs/"
+DEFAULT_THUMBNAIL_WIDTHS = [320, 640]
+DEFAULT_THUMBNAIL_FORMAT = "webp"
+DEFAULT_THUMBNAIL_QUALITY = 80
+
+def thumbnail_settings(config):
+
+    return {
+        "results_root": config["results_root"],
+        "thumbnails_root": config.get("thumbnails_root", DEFAULT_THUMBNAILS_ROOT),
+        "widths": config.get("thumbnail_widths", DEFAULT_THUMBNAIL_WIDTHS),
+        "format": config.get("thumbnail_format", DEFAULT_THUMBNAIL_FORMAT),
+        "quality": config.get("thumbnail_quality", DEFAULT_THUMBNAIL_QUALITY),
+    }
+
+def thumbnail_path(image_path, width, settings):
+    """
+    Thumbnail of a result image, mirroring its path
+    inside thumbnails_root: <run>/<prompt>/<source>_<width>w.webp
+    """
+
+    relative_path = os.path.relpath(image_path, settings["results_root"])
+    basename = os.path.splitext(relative_path)[0]
+    extension = "jpg" if settings["format"] == "jpeg" else settings["format"]
+
+    return os.path.join(
+        settings["thumbnails_root"],
+        f"{basename}_{width}w.{extension}"
+    )
+
+def generate_thumbnail(image_path, settings):
+    """
+    Generate every thumbnail width of image_path, skipping the ones
+    newer than the image. Return the number of thumbnails written,
+    0 when the image cannot be read.
+    """
+
+    # an unreadable or truncated result must not abort the build
+    try:
+        return write_thumbnails(image_path, settings)
+    except Exception as e:
+        print(f"❌ gen_thumbnails - {image_path} - {e}")
+        return 0
+
+def write_thumbnails(image_path, settings):
+
+    image_mtime = os.path.getmtime(image_path)
+
+    missing_widths = [
+        width for width in settings["widths"]
+        if not os.path.exists(thumbnail_path(image_path, width, settings))
+        or os.path.getmtime(thumbnail_path(image_path, width, settings)) < image_mtime
+    ]
+
+    if len(missing_widths) == 0:
+        return 0
+
+    with Image.open(image_path) as image:
+        image = image.convert("RGB")
+
+        # largest width first, each thumbnail is reduced
+        # from the previous one instead of the full image
+        for width in sorted(missing_widths, reverse=True):
+
+            output_path = thumbnail_path(image_path, width, settings)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+            if image.width > width:
+                height = round(image.height * width / image.width)
+                image = image.resize((width, height), Image.LANCZOS)
+
+            tmp_path = f"{output_path}.tmp"
+            image.save(
+                tmp_path,
+                format=settings["format"].upper(),
+                quality=settings["quality"]
+            )
+            os.replace(tmp_path, output_path)
+
+    return len(missing_widths)
+
+def generate_thumbnails(image_paths, config):
+
+    settings = thumbnail_settings(config)
+
+    if len(image_paths) == 0:
+        return 0
+
+    # resizing is CPU bound: spread images on every core
+    with ProcessPoolExecutor(max_workers=config.get("thumbnail_workers")) as executor:
+        counts = executor.map(
+            generate_thumbnail,
+            image_paths,
+            [settings] * len(image_paths),
+            chunksize=16
+        )
+
+        return sum(counts)
+
+def srcset(image_path, settings, root=""):
+
+    return ", ".join([
+        f"{root}{thumbnail_path(image_path, width, settings).replace('./static/', '')} {width}w"
+        for width in sorted(settings["widths"])
+    ])
+
+def find_results(config):
+
+    return [
+        os.path.join(root, filename)
+        for root, dirs, files in os.walk(config["results_root"])
+        for filename in files
+        if filename.endswith(".png")
+    ]
+
+def load_config():
+
+    if not os.path.exists(config_filepath):
+        raise OSError(f"❌ Config file not found: {config_filepath}")
+
+    with open(config_filepath, 'r') as f:
+        config = json.load(f)
+
+    if "results_root" not in config:
+        raise KeyError(f"❌ results_root not found in config file: {config_filepath}")
+
+    return config
+
+def main():
+
+    config = load_config()
+
+    result_paths = find_results(config)
+    count = generate_thumbnails(result_paths, config)
+
+    print(f"✔ gen_thumbnails - {count} thumbnails for {len(result_paths)} results")
+
+if __name__ == "__main__":
+    main()
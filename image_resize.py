@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import io
+import math
+import time
+
+from PIL import Image, ImageChops, ImageStat
+
+# SDXL resolution buckets
+SQUARE_SIZE = (1024, 1024)
+LANDSCAPE_SIZE = (1344, 768)
+PORTRAIT_SIZE = (768, 1344)
+
+def target_size(width, height):
+
+    if width == height:
+        return SQUARE_SIZE
+
+    if width > height:
+        return LANDSCAPE_SIZE
+
+    return PORTRAIT_SIZE
+
+def crop_box(width, height, target_width, target_height):
+    """
+    Centered box of the source image with the target aspect ratio,
+    i.e. the area left by the cover resize + center crop.
+    """
+
+    aspect_ratio = width / height
+    target_aspect_ratio = target_width / target_height
+
+    if aspect_ratio > target_aspect_ratio:
+        box_width = height * target_aspect_ratio
+        box_height = height
+    else:
+        box_width = width
+        box_height = width / target_aspect_ratio
+
+    left = (width - box_width) / 2
+    top = (height - box_height) / 2
+
+    return (left, top, left + box_width, top + box_height)
+
+def resize_cover(image, target_width, target_height, reducing_gap=2.0):
+    """
+    Resize and center crop image to exactly target_width x target_height.
+
+    The crop box is computed first, so only the kept area is resampled:
+    JPEG draft mode downscales in the decoder, Image.reduce does the
+    coarse integer step and LANCZOS only the final one.
+    """
+
+    width, height = image.size
+    left, top, right, bottom = crop_box(width, height, target_width, target_height)
+
+    # smallest decoded size keeping the crop box above the target size
+    image.draft("RGB", (
+        math.ceil(width * target_width / (right - left)),
+        math.ceil(height * target_height / (bottom - top))
+    ))
+    image = image.convert("RGB")
+
+    # draft changed the decoded size: scale the box accordingly
+    scale_x = image.size[0] / width
+    scale_y = image.size[1] / height
+    box = (left * scale_x, top * scale_y, right * scale_x, bottom * scale_y)
+
+    return image.resize(
+        (target_width, target_height),
+        Image.LANCZOS,
+        box=box,
+        reducing_gap=reducing_gap
+    )
+
+def resize_for_bucket(image):
+
+    target_width, target_height = target_size(*image.size)
+    resized_image = resize_cover(image, target_width, target_height)
+
+    return resized_image, target_width, target_height
+
+def legacy_resize_for_bucket(image):
+    """
+    Full decode, full resolution LANCZOS cover resize, then crop:
+    the previous get_resized_image_file implementation, kept as
+    the benchmark reference.
+    """
+
+    image = image.convert("RGB")
+    width, height = image.size
+    target_width, target_height = target_size(width, height)
+
+    aspect_ratio = width / height
+    target_aspect_ratio = target_width / target_height
+
+    if aspect_ratio > target_aspect_ratio:
+        new_height = target_height
+        new_width = int(new_height * aspect_ratio)
+    else:
+        new_width = target_width
+        new_height = int(new_width / aspect_ratio)
+
+    image = image.resize((new_width, new_height), Image.LANCZOS)
+
+    left = (new_width - target_width) // 2
+    top = (new_height - target_height) // 2
+    image = image.crop((left, top, left + target_width, top + target_height))
+
+    return image, target_width, target_height
+
+def benchmark(runs=5):
+    """
+    Compare both implementations on 12 megapixel JPEG photos
+    for the three aspect buckets.
+    """
+
+    photo_sizes = {
+        "landscape": (4032, 3024),
+        "portrait": (3024, 4032),
+        "square": (3464, 3464),
+    }
+
+    for bucket, size in photo_sizes.items():
+
+        # noisy gradient: a realistic JPEG decode cost
+        photo = Image.effect_mandelbrot(size, (-2.0, -1.5, 1.0, 1.5), 100).convert("RGB")
+        photo = Image.merge("RGB", (
+            photo.getchannel(0),
+            Image.linear_gradient("L").resize(size),
+            Image.effect_noise(size, 64)
+        ))
+
+        with io.BytesIO() as jpeg_bytes:
+            photo.save(jpeg_bytes, format="JPEG", quality=90)
+            jpeg_data = jpeg_bytes.getvalue()
+
+        results = {}
+        for name, resize in [
+                ("legacy", legacy_resize_for_bucket),
+                ("fast", resize_for_bucket),
+        ]:
+            start_time = time.perf_counter()
+            for _ in range(runs):
+                image, width, height = resize(Image.open(io.BytesIO(jpeg_data)))
+            results[name] = (image, (time.perf_counter() - start_time) / runs)
+
+        legacy_image, legacy_time = results["legacy"]
+        fast_image, fast_time = results["fast"]
+
+        if legacy_image.size != fast_image.size:
+            raise AssertionError(f"❌ {bucket}: {fast_image.size} != {legacy_image.size}")
+
+        difference = ImageStat.Stat(ImageChops.difference(legacy_image, fast_image)).mean
+
+        print(
+            f"✔ {bucket:9} {size[0]}x{size[1]} -> {fast_image.size[0]}x{fast_image.size[1]}"
+            f" - legacy {legacy_time * 1000:.0f}ms"
+            f" - fast {fast_time * 1000:.0f}ms"
+            f" - x{legacy_time / fast_time:.1f}"
+            f" - mean pixel diff {sum(difference) / len(difference):.2f}"
+        )
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = "./.cache/interrogator.db"
+DEFAULT_CACHE_SIZE = 10000
+
+# One cache per database file and per process
+caches = {}
+caches_lock = threading.Lock()
+
+def image_hash(image):
+    """
+    SHA-256 of the decoded pixels, so the same picture saved
+    with different metadata or compression gets the same hash.
+    """
+
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    digest.update(image.tobytes())
+
+    return digest.hexdigest()
+
+class InterrogatorCache:
+    """
+    Persistent image hash + interrogator settings -> prompt cache,
+    least recently used entries being evicted above max_entries.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_CACHE_SIZE):
+
+        directory = os.path.dirname(path)
+        if len(directory) > 0:
+            os.makedirs(directory, exist_ok=True)
+
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS interrogator_cache (
+            key TEXT PRIMARY KEY,
+            prompt TEXT,
+            last_used REAL
+        )
+        ''')
+        self.conn.execute('''
+        CREATE INDEX IF NOT EXISTS interrogator_cache_last_used
+        ON interrogator_cache (last_used)
+        ''')
+        self.conn.commit()
+
+    @staticmethod
+    def key(image_sha256, clip_model_name, mode):
+        return f"{image_sha256}:{clip_model_name}:{mode}"
+
+    def get(self, key):
+
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT prompt FROM interrogator_cache WHERE key = ?',
+                (key,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            self.conn.execute(
+                'UPDATE interrogator_cache SET last_used = ? WHERE key = ?',
+                (time.time(), key)
+            )
+            self.conn.commit()
+
+        return row[0]
+
+    def set(self, key, prompt):
+
+        with self.lock:
+            self.conn.execute('''
+            INSERT OR REPLACE INTO interrogator_cache (key, prompt, last_used)
+            VALUES (?, ?, ?)
+            ''', (key, prompt, time.time()))
+
+            # evict least recently used entries
+            self.conn.execute('''
+            DELETE FROM interrogator_cache WHERE key IN (
+                SELECT key FROM interrogator_cache
+                ORDER BY last_used DESC
+                LIMIT -1 OFFSET ?
+            )
+            ''', (self.max_entries,))
+            self.conn.commit()
+
+def open_cache(interrogator_config):
+    """
+    Return the shared cache configured in api.interrogator,
+    or None when cache_size is 0.
+    """
+
+    path = interrogator_config.get("cache_path", DEFAULT_CACHE_PATH)
+    max_entries = interrogator_config.get("cache_size", DEFAULT_CACHE_SIZE)
+
+    if max_entries == 0:
+        return None
+
+    with caches_lock:
+        if path not in caches:
+            caches[path] = InterrogatorCache(path, max_entries)
+
+    return caches[path]
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_MANIFEST_PATH = "./.cache/jobs.db"
+
+# prompt_data keys coming from config.json bookkeeping,
+# they do not change the image generated by a1111
+VOLATILE_KEYS = {"slug_id", "enabled", "forced", "positive", "negative"}
+
+def file_hash(path):
+
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+# api.interrogator keys changing the prompt sent to a1111
+INTERROGATOR_KEYS = ("clip_model_name", "mode", "sliced_top_prompts")
+
+def interrogator_settings(config):
+    """
+    Interrogator settings the generated prompt depends on,
+    None when the prompt is not interrogated.
+    """
+
+    if "interrogator" not in config["api"]:
+        return None
+
+    return {
+        key: config["api"]["interrogator"].get(key)
+        for key in INTERROGATOR_KEYS
+    }
+
+def job_hash(prompt_data, source_hash, interrogator=None):
+    """
+    Hash of the fully-merged prompt_data, of the source file and of the
+    interrogator settings, a job must be generated again as soon as one
+    of them changes.
+    """
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps(prompt_data, sort_keys=True).encode())
+    digest.update(source_hash.encode())
+
+    # unchanged hash without interrogator, for existing manifests
+    if interrogator is not None:
+        digest.update(json.dumps(interrogator, sort_keys=True).encode())
+
+    return digest.hexdigest()
+
+def request_fingerprint(prompt_data, source_hash, interrogator=None):
+    """
+    Fingerprint of the request actually sent to a1111, or None when
+    the seed is random and the same request gives another image.
+    """
+
+    if prompt_data.get("seed", -1) == -1:
+        return None
+
+    payload = {
+        key: value
+        for key, value in prompt_data.items()
+        if key not in VOLATILE_KEYS
+    }
+
+    return job_hash(payload, source_hash, interrogator)
+
+class JobManifest:
+    """
+    Persistent record of every generated output: input hash,
+    status, backend, latency. Backed by SQLite so each update is
+    atomic and a crashed run can resume from where it stopped.
+    """
+
+    def __init__(self, path=DEFAULT_MANIFEST_PATH):
+
+        directory = os.path.dirname(path)
+        if len(directory) > 0:
+            os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            output_path TEXT PRIMARY KEY,
+            input_hash TEXT,
+            status TEXT,
+            backend TEXT,
+            latency REAL,
+            updated_at REAL,
+            fingerprint TEXT
+        )
+        ''')
+
+        # manifests created before fingerprints were recorded
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(jobs)')]
+        if "fingerprint" not in columns:
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN fingerprint TEXT')
+
+        self.conn.execute('''
+        CREATE INDEX IF NOT EXISTS jobs_fingerprint
+        ON jobs (fingerprint)
+        ''')
+        self.conn.commit()
+
+        # source file hashes, memoized by path and mtime
+        self.source_hashes = {}
+
+    def source_hash(self, path):
+
+        key = (path, os.path.getmtime(path))
+        if key not in self.source_hashes:
+            self.source_hashes[key] = file_hash(path)
+
+        return self.source_hashes[key]
+
+    def get(self, output_path):
+
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT input_hash, status FROM jobs WHERE output_path = ?',
+                (output_path,)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            "input_hash": row[0],
+            "status": row[1]
+        }
+
+    def is_done(self, output_path, input_hash):
+        """
+        True when output_path was generated from the same inputs.
+        Outputs generated before the manifest existed are adopted
+        with the current inputs.
+        """
+
+        if not os.path.exists(output_path):
+            return False
+
+        job = self.get(output_path)
+
+        if job is None:
+            self.update(output_path, input_hash, "done")
+            return True
+
+        return job["status"] == "done" and job["input_hash"] == input_hash
+
+    def find_output(self, fingerprint, output_path, updated_after=0):
+        """
+        Path of an existing output, other than output_path, generated
+        from the same request since the updated_after timestamp.
+        """
+
+        with self.lock:
+            rows = self.conn.execute('''
+            SELECT output_path FROM jobs
+            WHERE fingerprint = ? AND status = ? AND output_path != ? AND updated_at >= ?
+            ''', (fingerprint, "done", output_path, updated_after)).fetchall()
+
+        for row in rows:
+            if os.path.exists(row[0]):
+                return row[0]
+
+        return None
+
+    def update(self, output_path, input_hash, status, backend=None, latency=None, fingerprint=None):
+
+        with self.lock:
+            self.conn.execute('''
+            INSERT OR REPLACE INTO jobs
+            (output_path, input_hash, status, backend, latency, updated_at, fingerprint)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (output_path, input_hash, status, backend, latency, time.time(), fingerprint))
+            self.conn.commit()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import copy
+
+def build_template(*parts):
+    """
+    Merge config dicts into a payload template. The template is a deep
+    copy, shared read-only by every request built from it.
+    """
+
+    template = {}
+    for part in parts:
+        template |= part
+
+    return copy.deepcopy(template)
+
+def controlnet_args(payload):
+
+    return payload.get("alwayson_scripts", {}).get("ControlNet", {}).get("args", [])
+
+def has_control_images(template):
+
+    return any("image" in control for control in controlnet_args(template))
+
+def specialise(template, control_image=None, reactor_args=None, **fields):
+    """
+    Payload for one request: shallow copies of the template and of
+    the dicts holding per-image fields, everything else is shared
+    with the template, which is never modified.
+    """
+
+    payload = dict(template)
+    payload.update(fields)
+
+    alwayson_scripts = dict(template.get("alwayson_scripts", {}))
+
+    controlnet_units = []
+    if "ControlNet" in alwayson_scripts:
+
+        # replace placeholder in controlnets
+        controlnet_units = [
+            dict(control, image=control_image) if "image" in control else control
+            for control in controlnet_args(template)
+        ]
+
+        alwayson_scripts["ControlNet"] = dict(
+            alwayson_scripts["ControlNet"],
+            args=controlnet_units
+        )
+
+    payload["controlnet_units"] = controlnet_units
+
+    if reactor_args is not None:
+        alwayson_scripts["reactor"] = {
+            "args": reactor_args
+        }
+
+    # templates without scripts only get them for reactor
+    if "alwayson_scripts" in template or reactor_args is not None:
+        payload["alwayson_scripts"] = alwayson_scripts
+
+    return payload
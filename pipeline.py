@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import asyncio
+import contextlib
+import time
+
+class Stage:
+    """
+    Bounded stage of the image pipeline: at most `limit` calls
+    in flight, the others waiting in its queue.
+    """
+
+    def __init__(self, name, limit):
+
+        self.name = name
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+
+        self.waiting = 0
+        self.running = 0
+        self.max_waiting = 0
+        self.done = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        start_time = time.monotonic()
+
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        self.wait_time += time.monotonic() - start_time
+        start_time = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.done += 1
+            self.run_time += time.monotonic() - start_time
+            self.semaphore.release()
+
+    def metrics(self):
+
+        return {
+            "limit": self.limit,
+            "waiting": self.waiting,
+            "running": self.running,
+            "max_waiting": self.max_waiting,
+            "done": self.done,
+            "avg_wait": self.wait_time / self.done if self.done else 0.0,
+            "avg_run": self.run_time / self.done if self.done else 0.0,
+        }
+
+class Pipeline:
+    """
+    Stages shared by every chat, so downloads, interrogations, LLM calls
+    and generations of different users overlap within their limits,
+    and one lock per chat so the messages of a chat are processed in order.
+    """
+
+    def __init__(self, limits):
+
+        self.stages = {
+            name: Stage(name, limit)
+            for name, limit in limits.items()
+        }
+
+        # chat id -> [lock, number of holders and waiters]
+        self.chat_locks = {}
+
+    def stage(self, name):
+        return self.stages[name].slot()
+
+    @contextlib.asynccontextmanager
+    async def chat(self, chat_id):
+
+        if chat_id not in self.chat_locks:
+            self.chat_locks[chat_id] = [asyncio.Lock(), 0]
+
+        chat_lock = self.chat_locks[chat_id]
+        chat_lock[1] += 1
+
+        try:
+            async with chat_lock[0]:
+                yield
+        finally:
+            # forget idle chats
+            chat_lock[1] -= 1
+            if chat_lock[1] == 0:
+                del self.chat_locks[chat_id]
+
+    def metrics(self):
+
+        return {
+            "chats": len(self.chat_locks),
+            "stages": {
+                name: stage.metrics()
+                for name, stage in self.stages.items()
+            }
+        }
+
+    def report(self):
+
+        return "\n".join([
+            f"{name}: {m['running']}/{m['limit']} running - {m['waiting']} waiting (max {m['max_waiting']})"
+            f" - {m['done']} done - avg wait {m['avg_wait']:.1f}s - avg run {m['avg_run']:.1f}s"
+            for name, m in self.metrics()["stages"].items()
+        ] + [f"chats in progress: {len(self.chat_locks)}"])
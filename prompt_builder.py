@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+import asyncio
+import collections
+import logging
+import re
+import traceback
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "claude-3-5-sonnet-latest"
+
+def prompt_message(interrogator_prompt, legend) -> str:
+
+    message_content = [
+        "You are an AI assistant tasked with processing messages from a Telegram channel and generating Stable Diffusion prompts based on the content. Each message contains a photo and a legend. Your job is to analyze both elements and create a prompt that will modify the original photo using Stable Diffusion.\n",
+        "You will receive two inputs:\n",
+        "<photo>\n",
+        str(interrogator_prompt),
+        "</photo>\n",
+        "<legend>\n",
+        str(legend),
+        "</legend>\n",
+        "Follow these steps to process the inputs and generate a Stable Diffusion prompt:\n",
+        "1. Analyze the photo:\n",
+        "   - Describe the main elements, subjects, and overall composition of the image.\n",
+        "   - Note any distinctive features, colors, or styles present in the photo.\n",
+        "2. Interpret the legend:\n",
+        "   - Identify key words, themes, or concepts mentioned in the legend.\n",
+        "   - Determine the mood, tone, or atmosphere suggested by the text.\n",
+        "3. Combine photo analysis and legend interpretation:\n",
+        "   - Find connections between the visual elements in the photo and the ideas expressed in the legend.\n",
+        "   - Identify aspects of the photo that could be enhanced or modified based on the legend.\n",
+        "4. Generate a Stable Diffusion prompt:\n",
+        "   - Start with a clear description of the main subject or scene from the original photo.\n",
+        "   - Replace the main subject by one or many pudgy penguins, or if not possible, include one pudgy penguin visual element.\n"
+        "   - DO NOT put bow tie on the  penguin.\n"
+        "   - Incorporate elements from the legend to guide the modification or enhancement of the image.\n",
+        "   - Use specific, descriptive language to convey the desired style, mood, and visual elements.\n",
+        "   - Include any relevant techniques, or references that align with the legend and original photo.\n",
+        "5. Refine and optimize the prompt:\n",
+        "   - Ensure the prompt is clear, concise, and focused.\n",
+        "   - Use Stable Diffusion-friendly terminology and structure.\n",
+        "   - Balance faithfulness to the original photo with creative interpretation of the legend.\n",
+        "6. Give a title for the work you have done:\n"
+        "   - the title should explain in 5-10 words what is visible on the image.\n",
+        "   - the title will be used as the caption for the generated image.\n",
+        "   - try to be funny, but don't overthink it: you are a clown that can make serious people laugh!\n",
+        "Provide your output in the following format:\n",
+        "<analysis>\n",
+        "[Your analysis of the photo and legend]\n",
+        "</analysis>\n",
+        "<stable_diffusion_prompt>\n",
+        "[Your generated Stable Diffusion prompt]\n",
+        "</stable_diffusion_prompt>\n",
+        "<title>\n",
+        "[Your generated Title for this work]\n",
+        "</title>\n",
+        "Remember to create a prompt that will result in a modified version of the original photo, incorporating elements from the legend while maintaining the essence of the original image."
+    ]
+
+    return "".join(message_content)
+
+def parse_response(text):
+    """
+    Return the (stable_diffusion_prompt, title) found in the LLM response.
+    """
+
+    pattern = r'<stable_diffusion_prompt>(.*?)</stable_diffusion_prompt>'
+    match = re.search(pattern, text, re.DOTALL)
+    if not match:
+        raise ValueError("No stable_diffusion_prompt found in the content")
+    api_call_prompt = match.group(1).strip()
+
+    pattern = r'<title>(.*?)</title>'
+    match = re.search(pattern, text, re.DOTALL)
+    if not match:
+        raise ValueError("No title found in the content")
+    caption_title = match.group(1).strip().replace('\n', '')
+
+    return api_call_prompt, caption_title
+
+def is_cacheable(interrogator_prompt):
+    """
+    False when the interrogation failed: no or empty result, or an error message,
+    the next request for the same photo must ask the LLM again.
+    """
+
+    # flask /interrogate answers an empty body when it failed
+    if not interrogator_prompt:
+        return False
+
+    if isinstance(interrogator_prompt, str) and interrogator_prompt.startswith("Sorry"):
+        return False
+
+    return True
+
+class PromptBuilder:
+    """
+    Build the Stable Diffusion prompt and caption of a photo with an
+    async Anthropic client, without blocking the event loop.
+
+    Results are cached by (interrogator prompt, legend), so /regen and
+    repeated captions reuse them, unless the interrogation failed. Without client, on error or after
+    `timeout` seconds, the prompt falls back to "legend, interrogator_prompt"
+    and the caption to the legend.
+
+    client is any object with an async messages.create(), e.g. a stub.
+    """
+
+    def __init__(self, client=None, model=DEFAULT_MODEL, timeout=30, cache_size=256):
+
+        self.client = client
+        self.model = model
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+    async def build(self, interrogator_prompt, legend):
+        """
+        Return the (api_call_prompt, caption_title) of a photo.
+        """
+
+        fallback = (f"{legend}, {interrogator_prompt}", legend)
+
+        if self.client is None:
+            return fallback
+
+        cacheable = is_cacheable(interrogator_prompt)
+
+        cache_key = (str(interrogator_prompt), str(legend))
+        if cacheable and cache_key in self.cache:
+            self.cache.move_to_end(cache_key)
+            return self.cache[cache_key]
+
+        # ask Claude to build prompt,
+        try:
+            message = await asyncio.wait_for(
+                self.client.messages.create(
+                    max_tokens=1024,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": prompt_message(interrogator_prompt, legend)
+                        }
+                    ],
+                    model=self.model,
+                ),
+                self.timeout
+            )
+
+            logger.info(message.content)
+
+            result = parse_response(message.content[0].text)
+
+        except asyncio.TimeoutError:
+            logger.error(f"Anthropic request timed out after {self.timeout}s")
+            return fallback
+        except Exception as e:
+            logger.error(f"Error during anthropic request: {e}")
+            logger.error(traceback.format_exc())
+            return fallback
+
+        if not cacheable:
+            return result
+
+        self.cache[cache_key] = result
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return result
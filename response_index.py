@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import collections
+import threading
+import time
+import uuid
+
+class ResponseIndex:
+    """
+    In-memory index of the generated responses, by id and by client,
+    so the latest response is found without listing UPLOAD_FOLDER.
+    The max_entries most recent responses keep their PNG bytes.
+    """
+
+    def __init__(self, max_entries=100):
+
+        self.max_entries = max_entries
+        self.responses = collections.OrderedDict()
+        self.latest_by_client = {}
+        self.latest_id = None
+        self.lock = threading.Lock()
+
+    def add(self, filename, png, client=None):
+
+        response_id = uuid.uuid4().hex
+
+        with self.lock:
+
+            self.responses[response_id] = {
+                "id": response_id,
+                "filename": filename,
+                "client": client,
+                "created_at": time.time(),
+                "png": png
+            }
+            self.latest_id = response_id
+            if client is not None:
+                self.latest_by_client[client] = response_id
+
+            while len(self.responses) > self.max_entries:
+                evicted_id, evicted = self.responses.popitem(last=False)
+                if self.latest_by_client.get(evicted["client"]) == evicted_id:
+                    del self.latest_by_client[evicted["client"]]
+
+        return response_id
+
+    def get(self, response_id=None, client=None):
+        """
+        Response by id, else latest response of client,
+        else latest response of all clients.
+        """
+
+        with self.lock:
+
+            if response_id is None and client is not None:
+                response_id = self.latest_by_client.get(client)
+
+            elif response_id is None:
+                response_id = self.latest_id
+
+            return self.responses.get(response_id)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import os
+import threading
+import time
+
+from PIL import Image
+from webuiapi import raw_b64_img
+
+from interrogator_cache import image_hash
+
+class SourceImage:
+    """
+    A decoded source image and the payloads derived from it,
+    each one computed on first use and shared by every job.
+    """
+
+    def __init__(self, path, image, store):
+
+        self.path = path
+        self.image = image
+        self.store = store
+
+        self.values = {}
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    def memo(self, name, fn):
+
+        with self.lock:
+
+            if name in self.values:
+                self.store.record_hit(self.durations[name])
+                return self.values[name]
+
+            start_time = time.monotonic()
+            self.values[name] = fn(self.image)
+            self.durations[name] = time.monotonic() - start_time
+            self.store.record_miss(self.durations[name])
+
+            return self.values[name]
+
+    def raw_b64(self):
+        return self.memo("raw_b64", raw_b64_img)
+
+    def b64(self):
+        return f"data:image/png;base64,{self.raw_b64()}"
+
+    def hash(self):
+        return self.memo("hash", image_hash)
+
+class SourceStore:
+    """
+    Decode each source file once per process, memoized by path and
+    mtime, and keep track of the encoding time saved by reusing it.
+    """
+
+    def __init__(self):
+
+        self.sources = {}
+        self.lock = threading.Lock()
+
+        self.encode_count = 0
+        self.encode_time = 0.0
+        self.reuse_count = 0
+        self.saved_time = 0.0
+
+    def get(self, path):
+
+        key = (path, os.path.getmtime(path))
+
+        with self.lock:
+
+            if key not in self.sources:
+                image = Image.open(path)
+                # decode now: lazy loading is not thread safe
+                image.load()
+                self.sources[key] = SourceImage(path, image, self)
+
+            return self.sources[key]
+
+    def record_miss(self, duration):
+        with self.lock:
+            self.encode_count += 1
+            self.encode_time += duration
+
+    def record_hit(self, duration):
+        with self.lock:
+            self.reuse_count += 1
+            self.saved_time += duration
+
+    def report(self):
+        return (
+            f"{len(self.sources)} sources, "
+            f"{self.encode_count} encodes in {self.encode_time:.2f}s, "
+            f"{self.reuse_count} reuses saved {self.saved_time:.2f}s"
+        )
@@ -4,10 +4,8 @@ import logging
 import json
 import os
 import exif
-import re
-import sqlite3
 from typing import Optional
-from aiohttp import ClientSession, FormData
+from aiohttp import ClientError, ClientSession, ClientTimeout, FormData, TCPConnector
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -17,7 +15,12 @@ from telegram.ext import (
     ContextTypes,
     CallbackQueryHandler
 )
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic
+
+from bot_db import BotDatabase, DEFAULT_DATABASE_PATH
+from api_health import ApiHealthMonitor
+from prompt_builder import PromptBuilder, DEFAULT_MODEL
+from pipeline import Pipeline
 
 CURRENT_MESSAGE_ID = None
 
@@ -44,55 +47,77 @@ def load_config(config_file="config.json"):
 config = load_config()
 client = None
 if "ANTHROPIC_API_KEY" in config:
-    client = Anthropic(api_key=config["ANTHROPIC_API_KEY"])
-
-# Database setup
-def setup_database():
-    conn = sqlite3.connect('bot_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS image_data (
-        message_id INTEGER PRIMARY KEY,
-        photo_file_id TEXT,
-        legend TEXT,
-        likes INTEGER DEFAULT 0
+    # ANTHROPIC_BASE_URL can point to a local stub
+    client = AsyncAnthropic(
+        api_key=config["ANTHROPIC_API_KEY"],
+        base_url=config.get("ANTHROPIC_BASE_URL")
     )
-    ''')
-    conn.commit()
-    conn.close()
 
-setup_database()
+prompt_builder = PromptBuilder(
+    client,
+    model=config.get("anthropic_model", DEFAULT_MODEL),
+    timeout=config.get("anthropic_timeout", 30),
+    cache_size=config.get("anthropic_cache_size", 256)
+)
 
-def save_image_data(message_id: int, photo_file_id: str, legend: Optional[str]):
-    """
-    Save image data to the SQLite database.
+# Database setup: one connection for the bot lifetime,
+# queried from a dedicated thread
+db = BotDatabase(config.get("database_path", DEFAULT_DATABASE_PATH))
 
-    Args:
-        message_id (int): The Telegram message ID.
-        photo_file_id (str): The file ID of the photo.
-        legend (Optional[str]): The caption of the photo, if any.
+# HTTP session shared by every API call, opened and closed with the application
+http_session: Optional[ClientSession] = None
+
+async def post_init(application: Application) -> None:
+    """
+    Open the API session: keep-alive connections reused by every call,
+    then start monitoring the API health.
     """
-    conn = sqlite3.connect('bot_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    INSERT INTO image_data (message_id, photo_file_id, legend)
-    VALUES (?, ?, ?)
-    ''', (message_id, photo_file_id, legend))
-    row_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return row_id
+    global http_session
+
+    connector = TCPConnector(
+        limit=config.get("api_connections", 16),
+        limit_per_host=config.get("api_connections", 16),
+        keepalive_timeout=config.get("api_keepalive_timeout", 60),
+        ttl_dns_cache=300
+    )
+
+    http_session = ClientSession(
+        connector=connector,
+        timeout=ClientTimeout(
+            total=None,
+            connect=config.get("api_connect_timeout", 5),
+            sock_read=config.get("api_read_timeout", 600)
+        )
+    )
+
+    await api_health.start()
+
+async def post_shutdown(application: Application) -> None:
+    """Stop the health monitor, close the API session and the database."""
+    await api_health.stop()
+
+    if http_session is not None:
+        await http_session.close()
+
+    db.close()
 
 async def is_api_online() -> bool:
     try:
-        async with ClientSession() as session:
-            prompts_url = f"{config['api_url']}{config['api_methods']['prompts']}"
-            async with session.get(prompts_url) as response:
-                return response.status == 200
+        prompts_url = f"{config['api_url']}{config['api_methods']['prompts']}"
+        async with http_session.get(prompts_url) as response:
+            return response.status == 200
     except Exception as e:
         logger.error(f"Error checking API url: {e}")
         return False
 
+# Last known API state, probed in the background: handlers never wait on it
+api_health = ApiHealthMonitor(
+    is_api_online,
+    interval=config.get("api_health_interval", 30),
+    retry_interval=config.get("api_health_retry_interval", 2),
+    max_interval=config.get("api_health_max_interval", 60)
+)
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send welcome message when the command /start is issued."""
     if update.message:
@@ -108,8 +133,7 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if update.message:
         reply_text = config["messages"]["info"]
 
-        is_online = await is_api_online()
-        if is_online:
+        if api_health.is_online():
             reply_text += "\n\n✅ API service available"
         else:
             reply_text += "\n\n❌ API service offline"
@@ -129,24 +153,29 @@ async def handle_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def interrogate_image_with_api(image_data: bytes) -> Optional[str]:
     """Send image to API and get interrogator result."""
     try:
-        async with ClientSession() as session:
-            prompt_data = FormData()
-            prompt_data.add_field(
-                'image',
-                image_data,
-                filename='telegram_image.jpg'
-            )
-            interrogate_url = f"{config['api_url']}{config['api_methods']['interrogate']}"
-            async with session.post(
-                interrogate_url,
-                data=prompt_data
-            ) as response:
-                if response.status == 404:
-                    return "Sorry this api call is not available"
-                if response.status == 200:
-                    return await response.read()
-                logger.error(f"API request failed with status {response.status}")
-                return None
+        prompt_data = FormData()
+        prompt_data.add_field(
+            'image',
+            image_data,
+            filename='telegram_image.jpg'
+        )
+        interrogate_url = f"{config['api_url']}{config['api_methods']['interrogate']}"
+        async with http_session.post(
+            interrogate_url,
+            data=prompt_data
+        ) as response:
+            api_health.mark_online()
+            if response.status == 404:
+                return "Sorry this api call is not available"
+            if response.status == 200:
+                # empty body: the interrogator failed on the server side
+                return await response.read() or None
+            logger.error(f"API request failed with status {response.status}")
+            return None
+    except ClientError as e:
+        api_health.mark_offline()
+        logger.error(f"Error processing image with API: {e}")
+        return None
     except Exception as e:
         logger.error(f"Error processing image with API: {e}")
         return None
@@ -154,30 +183,54 @@ async def interrogate_image_with_api(image_data: bytes) -> Optional[str]:
 async def process_image_with_api(image_data: bytes, prompt: str) -> Optional[bytes]:
     """Send image and prompt to API and get processed image back."""
     try:
-        async with ClientSession() as session:
-            prompt_data = FormData()
-            prompt_data.add_field('prompt-text', prompt)
-            prompt_data.add_field(
-                'image',
-                image_data,
-                filename='telegram_image.jpg'
-            )
-            gen_url = f"{config['api_url']}{config['api_methods']['gen']}"
-            async with session.post(
-                gen_url,
-                data=prompt_data
-            ) as response:
-                if response.status == 404:
-                    return "Sorry this prompt is not available"
-                if response.status == 200:
-                    return await response.read()
-                logger.error(f"API request failed with status {response.status}")
-                return None
+        prompt_data = FormData()
+        prompt_data.add_field('prompt-text', prompt)
+        prompt_data.add_field(
+            'image',
+            image_data,
+            filename='telegram_image.jpg'
+        )
+        gen_url = f"{config['api_url']}{config['api_methods']['gen']}"
+        async with http_session.post(
+            gen_url,
+            data=prompt_data
+        ) as response:
+            api_health.mark_online()
+            if response.status == 404:
+                return "Sorry this prompt is not available"
+            if response.status == 200:
+                return await response.read()
+            logger.error(f"API request failed with status {response.status}")
+            return None
+    except ClientError as e:
+        api_health.mark_offline()
+        logger.error(f"Error processing image with API: {e}")
+        return None
     except Exception as e:
         logger.error(f"Error processing image with API: {e}")
         return None
 
+# Stages shared by every chat, sized against the API and GPU capacity,
+# config.json stage_limits override some or all of them
+DEFAULT_STAGE_LIMITS = {
+    "download": 8,
+    "interrogate": 2,
+    "llm": 4,
+    "gen": 2
+}
+pipeline = Pipeline({**DEFAULT_STAGE_LIMITS, **config.get("stage_limits", {})})
+
 async def process_image(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id, legend) -> None:
+    """
+    Process images of different chats concurrently,
+    and the images of each chat in order.
+    """
+    async with pipeline.chat(update.message.chat_id):
+        await run_image_pipeline(update, context, file_id, legend)
+
+    logger.info(f"pipeline: {pipeline.metrics()}")
+
+async def run_image_pipeline(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id, legend) -> None:
     # Send "processing" message
     processing_msg = await update.message.reply_text(
         "📇 Processing your image... Please wait."
@@ -185,109 +238,28 @@ async def process_image(update: Update, context: ContextTypes.DEFAULT_TYPE, file
 
     try:
         # Download the photo
-        photo_file = await context.bot.get_file(file_id)
-        photo_bytes = await photo_file.download_as_bytearray()
+        async with pipeline.stage("download"):
+            photo_file = await context.bot.get_file(file_id)
+            photo_bytes = await photo_file.download_as_bytearray()
 
         # interrogate the image
-        interrogator_prompt = await interrogate_image_with_api(photo_bytes)
-
-        if client:
-            message_content = [
-                "You are an AI assistant tasked with processing messages from a Telegram channel and generating Stable Diffusion prompts based on the content. Each message contains a photo and a legend. Your job is to analyze both elements and create a prompt that will modify the original photo using Stable Diffusion.\n",
-                "You will receive two inputs:\n",
-                "<photo>\n",
-                str(interrogator_prompt),
-                "</photo>\n",
-                "<legend>\n",
-                str(legend),
-                "</legend>\n",
-                "Follow these steps to process the inputs and generate a Stable Diffusion prompt:\n",
-                "1. Analyze the photo:\n",
-                "   - Describe the main elements, subjects, and overall composition of the image.\n",
-                "   - Note any distinctive features, colors, or styles present in the photo.\n",
-                "2. Interpret the legend:\n",
-                "   - Identify key words, themes, or concepts mentioned in the legend.\n",
-                "   - Determine the mood, tone, or atmosphere suggested by the text.\n",
-                "3. Combine photo analysis and legend interpretation:\n",
-                "   - Find connections between the visual elements in the photo and the ideas expressed in the legend.\n",
-                "   - Identify aspects of the photo that could be enhanced or modified based on the legend.\n",
-                "4. Generate a Stable Diffusion prompt:\n",
-                "   - Start with a clear description of the main subject or scene from the original photo.\n",
-                "   - Replace the main subject by one or many pudgy penguins, or if not possible, include one pudgy penguin visual element.\n"
-                "   - DO NOT put bow tie on the  penguin.\n"
-                "   - Incorporate elements from the legend to guide the modification or enhancement of the image.\n",
-                "   - Use specific, descriptive language to convey the desired style, mood, and visual elements.\n",
-                "   - Include any relevant techniques, or references that align with the legend and original photo.\n",
-                "5. Refine and optimize the prompt:\n",
-                "   - Ensure the prompt is clear, concise, and focused.\n",
-                "   - Use Stable Diffusion-friendly terminology and structure.\n",
-                "   - Balance faithfulness to the original photo with creative interpretation of the legend.\n",
-                "6. Give a title for the work you have done:\n"
-                "   - the title should explain in 5-10 words what is visible on the image.\n",
-                "   - the title will be used as the caption for the generated image.\n",
-                "   - try to be funny, but don't overthink it: you are a clown that can make serious people laugh!\n",
-                "Provide your output in the following format:\n",
-                "<analysis>\n",
-                "[Your analysis of the photo and legend]\n",
-                "</analysis>\n",
-                "<stable_diffusion_prompt>\n",
-                "[Your generated Stable Diffusion prompt]\n",
-                "</stable_diffusion_prompt>\n",
-                "<title>\n",
-                "[Your generated Title for this work]\n",
-                "</title>\n",
-                "Remember to create a prompt that will result in a modified version of the original photo, incorporating elements from the legend while maintaining the essence of the original image."
-            ]
-
-            # DEBUG:
-            #await update.message.reply_text(
-            #    "".join(message_content)
-            #)
-
-            # ask Claude to build prompt,
-            try:
-                message = client.messages.create(
-                    max_tokens=1024,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": str("".join(message_content))
-                        }
-                    ],
-                    model="claude-3-5-sonnet-latest",
-                )
-
-                logger.info(message)
-                logger.info(message.content)
-
-                # await update.message.reply_text(
-                #     str(message.content[0])
-                # )
-
-                pattern = r'<stable_diffusion_prompt>(.*?)</stable_diffusion_prompt>'
-                match = re.search(pattern, str(message.content[0]), re.DOTALL)
-                if match:
-                    api_call_prompt = match.group(1).strip()
-
-                pattern = r'<title>(.*?)</title>'
-                match = re.search(pattern, str(message.content[0]), re.DOTALL)
-                if match:
-                    caption_title = match.group(1).strip().replace('\n', '')
-                else:
-                    raise ValueError("No stable_diffusion_prompt found in the content")
-            except Exception as e:
-                logger.error(f"Error during anthropic request: {e}")
-                logger.error(traceback.format_exc())
-                api_call_prompt = f"{legend}, {interrogator_prompt}"
-        else:
-            api_call_prompt = f"{legend}, {interrogator_prompt}"
+        async with pipeline.stage("interrogate"):
+            interrogator_prompt = await interrogate_image_with_api(photo_bytes)
+
+        # build the prompt and caption, cached by (interrogator prompt, legend)
+        async with pipeline.stage("llm"):
+            api_call_prompt, caption_title = await prompt_builder.build(
+                interrogator_prompt,
+                legend
+            )
 
-        result_image = await process_image_with_api(photo_bytes, api_call_prompt)
+        async with pipeline.stage("gen"):
+            result_image = await process_image_with_api(photo_bytes, api_call_prompt)
         await processing_msg.delete()
 
         if result_image:
             # Save image data and get the row id
-            row_id = save_image_data(update.message.message_id, file_id, legend)
+            row_id = await db.save_image_data(update.message.message_id, file_id, legend)
 
             # Create inline keyboard with shorter callback data
             keyboard = [
@@ -322,8 +294,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     # Check if api online
-    is_online = await is_api_online()
-    if not is_online:
+    if not api_health.is_online():
         await update.message.reply_text(
             "❌ API server is not online"
         )
@@ -372,10 +343,7 @@ async def regen_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         row_id = int(query.data.split(':')[1])
 
         # Retrieve the original file_id and legend from the database
-        conn = sqlite3.connect('bot_data.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT photo_file_id, legend FROM image_data WHERE rowid = ?', (row_id,))
-        result = cursor.fetchone()
+        result = await db.get_image_data(row_id)
 
         if not result:
             raise ValueError(f"No message found with message_id {message_id}")
@@ -388,23 +356,6 @@ async def regen_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     except Exception as e:
         logger.error(f"Error in regen_command: {str(e)}")
         await update.message.reply_text("An error occurred while processing your request. Please try again later.")
-    finally:
-        conn.close()
-
-def like_message(row_id) -> None:
-    try:
-        # Fetch the message from the database
-        conn = sqlite3.connect('bot_data.db')
-        cursor = conn.cursor()
-
-        # Add a like counter for each message
-        cursor.execute('UPDATE image_data SET likes = likes + 1 WHERE rowid = ?', (row_id,))
-        conn.commit()
-
-    except Exception as e:
-        logger.error(f"Error in like_message: {str(e)}")
-    finally:
-        conn.close()
 
 async def like_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -426,13 +377,11 @@ async def like_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         query = update.callback_query
         await query.answer()
         row_id = int(query.data.split(':')[1])
-        like_message(row_id)
 
-        conn = sqlite3.connect('bot_data.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT likes FROM image_data WHERE rowid = ?', (row_id,))
-        likes = cursor.fetchone()[0]
-        conn.close()
+        # Add a like and get the new total in one query
+        likes = await db.like(row_id)
+        if likes is None:
+            raise ValueError(f"No message found with message_id {message_id}")
 
         await update.message.reply_text(f"👍 Like added! Total likes: {likes}")
 
@@ -441,8 +390,11 @@ async def like_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     except Exception as e:
         logger.error(f"Error in like_command: {str(e)}")
         await update.message.reply_text("An error occurred while processing your request.")
-    finally:
-        conn.close()
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send the pipeline stages queue depths when the command /stats is issued."""
+    if update.message:
+        await update.message.reply_text(pipeline.report())
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
@@ -454,31 +406,31 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     row_id = int(data[1])
 
     if action == 'regen':
-        conn = sqlite3.connect('bot_data.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT photo_file_id, legend FROM image_data WHERE rowid = ?', (row_id,))
-        result = cursor.fetchone()
-        conn.close()
+        result = await db.get_image_data(row_id)
 
         if result:
             file_id, legend = result
             await process_image(query, context, file_id, legend)
 
     elif action == 'like':
-        like_message(row_id)
+        likes = await db.like(row_id)
 
-        conn = sqlite3.connect('bot_data.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT likes FROM image_data WHERE rowid = ?', (row_id,))
-        likes = cursor.fetchone()[0]
-        conn.close()
-
-        await query.message.reply_text(f"👍 Like added! Total likes: {likes}")
+        if likes is not None:
+            await query.message.reply_text(f"👍 Like added! Total likes: {likes}")
 
 def main() -> None:
     """Start the bot."""
     # Create the Application
-    application = Application.builder().token(config["bot_token"]).build()
+    application = (
+        Application.builder()
+        .token(config["bot_token"])
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # updates of different chats are handled concurrently,
+        # pipeline stages bound the work in flight
+        .concurrent_updates(config.get("concurrent_updates", 64))
+        .build()
+    )
 
     # Add handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -486,6 +438,7 @@ def main() -> None:
     application.add_handler(CommandHandler("info", info_command))
     application.add_handler(CommandHandler("regen", regen_command))
     application.add_handler(CommandHandler("like", like_command))
+    application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_member))
     application.add_handler(MessageHandler(filters.PHOTO, handle_message))
     application.add_handler(CallbackQueryHandler(button_callback))
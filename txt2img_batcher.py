@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import threading
+
+from payload_template import has_control_images
+
+# Keys set by the batcher, not part of the request compatibility
+BATCH_KEYS = {"seed", "batch_size", "n_iter"}
+
+class Txt2ImgBatcher:
+    """
+    Coalesce concurrent txt2img requests sharing the same payload into
+    a single a1111 call with batch_size set, then fan the images back.
+
+    Only requests with a random seed are batched: a1111 gives the
+    images of a batch consecutive seeds, which would break the result
+    expected from a fixed seed. Requests embedding their upload as a
+    ControlNet or ReActor input never match another one, they are sent
+    right away.
+    """
+
+    def __init__(self, post_txt2img, window=0.02, max_batch_size=4):
+
+        self.post_txt2img = post_txt2img
+        self.window = window
+        self.max_batch_size = max_batch_size
+
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def batch_key(payload):
+
+        digest = hashlib.sha256()
+        digest.update(json.dumps(
+            {
+                key: value
+                for key, value in payload.items()
+                if key not in BATCH_KEYS
+            },
+            sort_keys=True
+        ).encode())
+
+        return digest.hexdigest()
+
+    def submit(self, payload):
+        """
+        Send payload, possibly along with other compatible requests,
+        and return its generated image.
+        """
+
+        if (
+                self.max_batch_size <= 1
+                or payload.get("seed", -1) != -1
+                or payload.get("batch_size", 1) != 1
+                or payload.get("n_iter", 1) != 1
+                or has_control_images(payload)
+                or "reactor" in payload.get("alwayson_scripts", {})
+        ):
+            return self.post_txt2img(payload).images[0]
+
+        key = self.batch_key(payload)
+        request = {
+            "event": threading.Event(),
+            "image": None,
+            "error": None
+        }
+
+        with self.lock:
+
+            batch = self.batches.get(key)
+
+            if batch is None:
+                batch = {
+                    "payload": payload,
+                    "requests": []
+                }
+                self.batches[key] = batch
+
+                timer = threading.Timer(self.window, self.flush, args=(key, batch))
+                timer.daemon = True
+                timer.start()
+
+            batch["requests"].append(request)
+            is_full = len(batch["requests"]) >= self.max_batch_size
+
+        if is_full:
+            self.flush(key, batch)
+
+        request["event"].wait()
+
+        if request["error"] is not None:
+            raise request["error"]
+
+        return request["image"]
+
+    def flush(self, key, batch):
+
+        with self.lock:
+
+            # already flushed by the timer or by a full batch
+            if self.batches.get(key) is not batch:
+                return
+
+            del self.batches[key]
+
+        requests = batch["requests"]
+        payload = dict(batch["payload"])
+        payload["batch_size"] = len(requests)
+
+        try:
+            response = self.post_txt2img(payload)
+
+            # controlnet detected maps come after the generated images
+            if len(response.images) < len(requests):
+                raise RuntimeError(f"❌ batch returned {len(response.images)} images for {len(requests)} requests")
+
+            for request, image in zip(requests, response.images):
+                request["image"] = image
+
+        except Exception as e:
+            for request in requests:
+                request["error"] = e
+
+        finally:
+            for request in requests:
+                request["event"].set()
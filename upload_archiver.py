@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class UploadArchiver:
+    """
+    Write uploads and generated images to disk from a background
+    thread, so the request path never waits on the filesystem.
+    """
+
+    def __init__(self, folder, enabled=True, max_pending=256):
+
+        self.folder = folder
+        self.enabled = enabled
+        self.queue = queue.Queue(maxsize=max_pending)
+
+        if self.enabled:
+            os.makedirs(self.folder, exist_ok=True)
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def archive(self, filename, data, image_format=None):
+        """
+        Queue data for filename: raw bytes, or a PIL image
+        encoded with image_format in the archiver thread.
+        """
+
+        if not self.enabled:
+            return
+
+        try:
+            self.queue.put_nowait((filename, data, image_format))
+        except queue.Full:
+            logger.error(f"❌ archiver queue full, dropping {filename}")
+
+    def run(self):
+
+        while True:
+
+            filename, data, image_format = self.queue.get()
+            path = os.path.join(self.folder, filename)
+            tmp_path = f"{path}.tmp"
+
+            try:
+                if isinstance(data, bytes):
+                    with open(tmp_path, "wb") as f:
+                        f.write(data)
+                else:
+                    data.save(tmp_path, format=image_format)
+
+                os.replace(tmp_path, path)
+
+            except Exception as e:
+                logger.error(f"❌ archiver failed to write {path}: {e}")
+
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        self.queue.join()
+
+    def prune(self, max_age=None, max_bytes=None):
+        """
+        Delete files older than max_age seconds, then the oldest
+        files until the folder is under max_bytes.
+        Return the number of deleted files.
+        """
+
+        # stat each file once: the archiver thread writes and renames
+        # files meanwhile, in-flight .tmp files are left alone
+        files = []
+        for entry in os.scandir(self.folder):
+
+            if entry.name.endswith(".tmp"):
+                continue
+
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            files.append((entry.path, stat.st_mtime, stat.st_size))
+
+        files.sort(key=lambda file: file[1])
+
+        total_bytes = sum(size for path, mtime, size in files)
+        expired_before = time.time() - max_age if max_age else None
+        deleted = 0
+
+        for path, mtime, size in files:
+
+            is_expired = expired_before is not None and mtime < expired_before
+            is_over_size = max_bytes is not None and total_bytes > max_bytes
+
+            if not is_expired and not is_over_size:
+                break
+
+            try:
+                os.remove(path)
+                total_bytes -= size
+                deleted += 1
+            except FileNotFoundError:
+                total_bytes -= size
+            except OSError as e:
+                logger.error(f"❌ archiver failed to prune {path}: {e}")
+
+        return deleted
+
+    def start_pruning(self, interval, max_age=None, max_bytes=None):
+
+        if not self.enabled or (max_age is None and max_bytes is None):
+            return
+
+        def prune_loop():
+            while True:
+                # an error must not stop the retention for good
+                try:
+                    deleted = self.prune(max_age, max_bytes)
+                    if deleted > 0:
+                        logger.info(f"✔ archiver pruned {deleted} files")
+                except Exception as e:
+                    logger.error(f"❌ archiver failed to prune {self.folder}: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=prune_loop, daemon=True).start()